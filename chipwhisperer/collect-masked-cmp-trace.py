@@ -167,3 +167,5 @@ with open(TRACE_FILE, 'wb') as output_f:
             continue
 
         output_f.write(tr_dec)
+        # make every complete pair visible to `main.py physical --online`
+        output_f.flush()
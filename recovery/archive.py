@@ -0,0 +1,117 @@
+import io
+import os
+import sys
+import glob
+import gzip
+import tarfile
+import numpy as np
+from util import SIMPLECOMPBITS
+
+
+class ConcatenatedFiles(io.RawIOBase):
+    # Equivalent of `cat *.tar.gz`: the bundles are read back to back without unpacking
+    def __init__(self, files):
+        self.files = list(files)
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.current is None:
+                if not self.files:
+                    return 0
+                self.current = open(self.files.pop(0), 'rb')
+            n = self.current.readinto(buffer)
+            if n:
+                return n
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+        super().close()
+
+
+def find_archives(directory="../traces"):
+    return sorted(glob.glob(f"{directory}/*.tar.gz"))
+
+
+def read_exact(f, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            raise EOFError(f"Archive member ended after {len(data)} of {size} bytes")
+        data += chunk
+    return bytes(data)
+
+
+class ArchiveMember:
+    def __init__(self, archives, name):
+        self.archives = archives
+        self.name = os.path.basename(name)
+
+    def __enter__(self):
+        self.raw = ConcatenatedFiles(self.archives)
+        # Like `tar -xzf - -i`: gzip members and tar end-of-archive blocks of every bundle are skipped
+        self.tar = tarfile.open(fileobj=gzip.GzipFile(fileobj=io.BufferedReader(self.raw)), mode='r|', ignore_zeros=True)
+        for member in self.tar:
+            if member.isfile() and os.path.basename(member.name) == self.name:
+                return self.tar.extractfile(member)
+        self.__exit__(None, None, None)
+        raise FileNotFoundError(f"{self.name} not found in {self.archives}")
+
+    def __exit__(self, *args):
+        self.tar.close()
+        self.raw.close()
+
+
+def iter_archive_traces(archives, name, chunk_traces=256):
+    # Yields (trace_num, samples_per_trace) from the header first, then chunks of traces
+    with ArchiveMember(archives, name) as f:
+        trace_num = 2*int.from_bytes(read_exact(f, 4), byteorder="big")
+        samples_per_trace = int.from_bytes(read_exact(f, 4), byteorder="big")
+        yield trace_num, samples_per_trace
+        for start in range(0, trace_num, chunk_traces):
+            count = min(chunk_traces, trace_num - start)
+            data = read_exact(f, 8*count*samples_per_trace)
+            yield np.frombuffer(data, dtype=np.float64).reshape((count, samples_per_trace))
+
+
+def read_traces_from_archive(ntraces, nshares, archives, file, file_bc, ignore_bc):
+    print(f"Streaming {os.path.basename(file)} from {len(archives)} archives..")
+    chunks = iter_archive_traces(archives, file)
+    trace_num, samples_per_trace = next(chunks)
+    assert trace_num == 2*ntraces, f"{trace_num} != {ntraces}"
+    traces = np.empty((trace_num, samples_per_trace))
+    start = 0
+    for chunk in chunks:
+        traces[start:start+chunk.shape[0]] = chunk
+        start += chunk.shape[0]
+    print(f"Read {traces.shape} floats.")
+    print(f"{trace_num=}")
+    if ignore_bc:
+        bcs = None
+    else:
+        with ArchiveMember(archives, file_bc) as f:
+            read_exact(f, 4)
+            data = read_exact(f, 4*SIMPLECOMPBITS*nshares*trace_num)
+        bcs = np.frombuffer(data, dtype=np.uint32).reshape((trace_num, SIMPLECOMPBITS, nshares))
+    return traces, bcs
+
+
+def main():
+    # List the trace files available in the bundles
+    archives = find_archives(sys.argv[1] if len(sys.argv) > 1 else "../traces")
+    raw = ConcatenatedFiles(archives)
+    with tarfile.open(fileobj=gzip.GzipFile(fileobj=io.BufferedReader(raw)), mode='r|', ignore_zeros=True) as tar:
+        for member in tar:
+            if member.isfile():
+                print(f"{member.name} {member.size}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
+import time
 import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from util import take_nth, bits
+from instrument import phase
 
 
 def eval_attack(res_is_success, name):
@@ -27,20 +31,50 @@ def eval_attack(res_is_success, name):
     return total, correct, ratio_correct, classified, ratio_classified
 
 
-def attack(traces, pois, nshares, name="", build_single_trace_template=None, upper_bound=0.55, verbose=True, number_of_traces=None, test_mode=True, template_function=None):
+def attack(traces, pois, nshares, name="", build_single_trace_template=None, upper_bound=0.55, verbose=True, number_of_traces=None, test_mode=True, template_function=None, batch=True, build_batch_template=None, workers=1):
     print(f"######## {name.upper()} ########")
-    if template_function is not None:
-        print("Building templates..")
-        template_function()
-    print("Applying templates to every trace..")
+    with phase(name):
+        if template_function is not None:
+            print("Building templates..")
+            with phase("build template"):
+                template_function()
+        print("Applying templates to every trace..")
+        if number_of_traces is None:
+            number_of_traces = traces.shape[0]
+        else:
+            number_of_traces = min(traces.shape[0], number_of_traces)
+        with phase("apply template", ntraces=number_of_traces):
+            if workers > 1:
+                res_is_success = classify_traces_parallel(traces[:number_of_traces], pois, nshares, upper_bound, build_single_trace_template, batch, build_batch_template, workers)
+            else:
+                res_is_success = classify_traces(traces[:number_of_traces], pois, nshares, upper_bound, build_single_trace_template, batch, build_batch_template, progress=True)
+
+        with phase("evaluate"):
+            if test_mode:
+                retv = eval_attack(res_is_success, name)
+            else:
+                print(res_is_success)
+                retv = res_is_success
+
+    print("Resetting template..")
+    pois.reset_template()
+    print("##############################################")
+    print()
+
+    return retv
+
+
+def classify_traces(traces, pois, nshares, upper_bound, build_single_trace_template=None, batch=True, build_batch_template=None, progress=False):
     res_is_success = []
-    if number_of_traces is None:
-        number_of_traces = traces.shape[0]
-    else:
-        number_of_traces = min(traces.shape[0], number_of_traces)
+    if batch and (build_single_trace_template is None or build_batch_template is not None):
+        # Classified per chunk, so the likelihoods of all traces are never held at once
+        chunk_size = pois.get_trace_chunk_size()
+        for start in range(0, traces.shape[0], chunk_size):
+            rec_bits, _, _ = pois.apply_template_batch(traces[start:start+chunk_size], chunk_size=chunk_size, build_template=build_batch_template)
+            res_is_success += classify_batch(rec_bits, upper_bound)
+        return res_is_success
+    start = time.perf_counter()
     for idx_tr in range(traces.shape[0]):
-        if number_of_traces is not None and idx_tr >= number_of_traces:
-            break
         if build_single_trace_template is not None:
             build_single_trace_template(pois, traces[idx_tr])
         rec = pois.apply_template(traces[idx_tr])
@@ -48,44 +82,57 @@ def attack(traces, pois, nshares, name="", build_single_trace_template=None, upp
             pois.reset_template()
         suc = classify_from_recovered(rec, idx_tr, upper_bound, nshares)
         res_is_success.append(suc)
-        print(f"{idx_tr}/{number_of_traces}" + " "*20, end='\r')
+        if progress:
+            print(f"{idx_tr}/{traces.shape[0]}, {(idx_tr + 1)/(time.perf_counter() - start):.1f} traces/s" + " "*20, end='\r')
+    return res_is_success
 
-    if test_mode:
-        retv = eval_attack(res_is_success, name)
-    else:
-        print(res_is_success)
-        retv = res_is_success
 
-    print("Resetting template..")
-    pois.reset_template()
-    print("##############################################")
-    print()
+def classify_shared_traces(shm_name, shape, start, stop, pois, *args):
+    # Worker side: the traces are read in place from the shared memory block
+    shm = shared_memory.SharedMemory(name=shm_name)
+    traces = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    res_is_success = classify_traces(traces[start:stop], pois, *args)
+    del traces
+    shm.close()
+    return res_is_success
 
-    return retv
+
+def classify_traces_parallel(traces, pois, nshares, upper_bound, build_single_trace_template=None, batch=True, build_batch_template=None, workers=2):
+    shape = traces.shape
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 8*shape[0]*shape[1]))
+    try:
+        shared = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        for start in range(0, shape[0], 256):
+            shared[start:start+256] = np.asarray(traces[start:start+256])
+        del shared
+        # A few blocks per worker so uneven per-trace work is balanced, verdicts come back in trace order
+        bounds = np.linspace(0, shape[0], min(shape[0], 4*workers) + 1).astype(int)
+        res_is_success = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(classify_shared_traces, shm.name, shape, start, stop, pois, nshares, upper_bound, build_single_trace_template, batch, build_batch_template) for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                res_is_success += future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+    return res_is_success
 
 
 def classify_from_recovered(rec, idx_tr, upper_bound, nshares):
-    total = 0
-    zeros = 0
-    for idx_bc in range(len(rec)):
-        final = np.array([0 for _ in range(32)])
-        for idx_share in range(nshares):
-            share = take_nth(rec[idx_bc][idx_share], 0)
-            final = final + np.array(share)
-        final = [b % 2 for b in final]
-        zeros += len(final) - sum(final)
-        total += len(final)
-    ratio_correct = zeros/total
-    if ratio_correct > 0.8:
-        return True
-        if idx_tr % 2 != 0:
-            print(f"False positive: {idx_tr=}, {ratio_correct=}")
-    elif ratio_correct < upper_bound:
-        return False
-        if idx_tr % 2 != 1:
-            print(f"False negative: {idx_tr=}, {ratio_correct=}")
-    else:
-        return None
+    rec_bits = np.array([[take_nth(rec_share, 0) for rec_share in rec_bc[:nshares]] for rec_bc in rec])
+    return classify_batch(rec_bits[None], upper_bound)[0]
+
+
+def classify_batch(rec_bits, upper_bound):
+    # rec_bits: (ntraces, nbcs, nshares, 32), the unmasked BC is the XOR of all shares
+    final = np.bitwise_xor.reduce(rec_bits.astype(np.uint8), axis=2)
+    final = final.reshape((final.shape[0], -1))
+    zeros = np.count_nonzero(final == 0, axis=1)
+    ratio_correct = zeros/final.shape[1]
+    res_is_success = np.full(final.shape[0], None, dtype=object)
+    res_is_success[ratio_correct < upper_bound] = False
+    res_is_success[ratio_correct > 0.8] = True
+    return res_is_success.tolist()
 
 
 def attack_one_trace(traces, bcs, tr_idx, pois, name="", template_function=None):
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# ##### DESCRIPTION ######
+# Times the recovery hot paths on synthetic traces and writes the results
+# (seconds, traces/s and peak traced memory per stage) to a JSON file.
+# Pass --baseline with an earlier output to fail on regressions, e.g.
+#   ./benchmark.py --output ../bench/new.json --baseline ../bench/baseline.json
+##########################
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from poi import PoisCollection
+from util import SIMPLECOMPBITS, read_traces, write_traces
+from simulation import Simulator
+
+
+def measure(fn, ntraces):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "traces_per_s": ntraces/seconds if seconds > 0 else float("inf"), "peak_bytes": peak}
+
+
+def synthetic_campaign(nshares, ntraces, npois, samples, sigma, seed):
+    # Simulated POI samples followed by pure noise, BCs padded to SIMPLECOMPBITS words
+    sim = Simulator(sigma, 1, nshares, npois, rng=np.random.default_rng(seed))
+    sim.find_pois()
+    traces, bcs = sim.record_traces_batch(ntraces, append=False)
+    noise = sim.rng.normal(0, sigma, size=(ntraces, max(0, samples - traces.shape[1])))
+    traces = np.concatenate([traces, noise], axis=1)
+    bcs_all = sim.rng.integers(0, 1 << 32, size=(ntraces, SIMPLECOMPBITS, nshares), dtype=np.uint32)
+    bcs_all[:, :1] = bcs
+    return sim, traces, bcs_all
+
+
+def run_config(nshares, ntraces, npois, samples, sigma, seed, per_trace_limit, directory):
+    config = {"nshares": nshares, "ntraces": ntraces, "npois": npois, "samples": samples}
+    results = []
+
+    def record(stage, fn, n=ntraces):
+        res = measure(fn, n)
+        res.update(config, stage=stage)
+        print(f"{stage:>32} {nshares=} {ntraces=} {npois=}: {res['seconds']:.4f}s, {res['traces_per_s']:.1f} traces/s, {res['peak_bytes']/2**20:.1f} MiB")
+        results.append(res)
+
+    sim, traces, bcs = synthetic_campaign(nshares, ntraces, npois, samples, sigma, seed)
+    file = f"{directory}/traces.bin"
+    file_bc = f"{directory}/bcs.bin"
+    write_traces(file, traces, file_bc, bcs)
+    n_single = min(ntraces, per_trace_limit)
+    pois = None
+
+    def find_all_pois():
+        nonlocal pois
+        pois = PoisCollection.find_all_pois(traces, bcs, num_pois_per_bit=npois)
+
+    record("read_traces", lambda: read_traces(ntraces//2, nshares, file, file_bc, False))
+    record("read_traces_mmap", lambda: np.sum(read_traces(ntraces//2, nshares, file, file_bc, False, mmap=True)[0][:, 0]))
+    record("record_trace", lambda: [sim.record_trace(i & 1 == 1, append=False) for i in range(n_single)], n_single)
+    record("record_traces_batch", lambda: sim.record_traces_batch(ntraces, append=False))
+    record("find_all_pois", find_all_pois)
+    record("compute_template_from_bc", lambda: pois.compute_template_from_bc(traces, bcs))
+    record("apply_template", lambda: [pois.apply_template(trace) for trace in traces[:n_single]], n_single)
+    record("apply_template_batch", lambda: pois.apply_template_batch(traces))
+    pois.reset_template()
+    record("compute_vertical_auto_template", lambda: pois.compute_vertical_auto_template(traces))
+    pois.reset_template()
+
+    def horizontal_per_trace():
+        for trace in traces[:n_single]:
+            pois.compute_horizontal_auto_template(trace)
+            pois.apply_template(trace)
+            pois.reset_template()
+
+    record("horizontal_auto_template", horizontal_per_trace, n_single)
+    record("horizontal_auto_template_batch", lambda: pois.apply_template_batch(traces, build_template=PoisCollection.compute_horizontal_auto_template_batch))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    def key(r):
+        return (r["stage"], r["nshares"], r["ntraces"], r["npois"], r["samples"])
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        ratio = r["seconds"]/b["seconds"] if b["seconds"] > 0 else 1.0
+        r["baseline_ratio"] = ratio
+        if ratio > tolerance:
+            regressions.append(r)
+            print(f"REGRESSION: {r['stage']} {key(r)[1:]} took {ratio:.2f}x the baseline time")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Benchmarking the recovery hot paths')
+    parser.add_argument('--shares', type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument('--ntraces', type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument('--pois', type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument('--samples', type=int, help="Samples per synthetic trace", default=2000)
+    parser.add_argument('--sigma', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--per-trace-limit', type=int, help="Traces used for the per-trace stages", default=100)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, help="Allowed slowdown relative to the baseline", default=1.2)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for nshares in args.shares:
+            for ntraces in args.ntraces:
+                for npois in args.pois:
+                    results += run_config(nshares, ntraces, npois, args.samples, args.sigma, args.seed, args.per_trace_limit, directory)
+
+    regressions = []
+    if args.baseline is not None:
+        try:
+            with open(args.baseline, 'r') as f:
+                regressions = compare(results, json.load(f), args.tolerance)
+        except (OSError, ValueError) as e:
+            print(f"Unable to read baseline {args.baseline}: {e}", file=sys.stderr)
+
+    report = {
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output is not None:
+        try:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1)
+            print(f"Wrote {args.output}.")
+        except OSError as e:
+            print(f"Unable to write {args.output}: {e}", file=sys.stderr)
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
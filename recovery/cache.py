@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+
+class ArtifactCache:
+    def __init__(self, directory="../cache", max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def hash_file(self, file):
+        # Content hashes are remembered per (path, size, mtime) so unchanged files are not re-read
+        stat = os.stat(file)
+        ident = f"{os.path.realpath(file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        index_file = f"{self.directory}/hashes.json"
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if ident in index:
+            return index[ident]
+        digest = hashlib.sha256()
+        with open(file, 'rb') as f:
+            while chunk := f.read(1 << 24):
+                digest.update(chunk)
+        # Entries of deleted files and older versions of this file are dropped, so the index does not grow
+        path = os.path.realpath(file)
+        index = {k: v for k, v in index.items() if k.rsplit(":", 2)[0] != path and os.path.exists(k.rsplit(":", 2)[0])}
+        index[ident] = digest.hexdigest()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(index_file, 'w') as f:
+                json.dump(index, f)
+        except OSError as e:
+            print(f"Unable to write {index_file}: {e}", file=sys.stderr)
+        return index[ident]
+
+    def key(self, files=(), arrays=(), **params):
+        digest = hashlib.sha256()
+        for file in files:
+            digest.update(self.hash_file(file).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(f"{array.shape}{array.dtype.str}".encode())
+            digest.update(array.tobytes())
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()[:32]
+
+    def path(self, kind, key):
+        return f"{self.directory}/{kind}-{key}.npz"
+
+    def load(self, kind, key):
+        path = self.path(kind, key)
+        try:
+            with np.load(path) as artifacts:
+                artifacts = dict(artifacts)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return artifacts
+
+    def store(self, kind, key, **arrays):
+        path = self.path(kind, key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.tmp", 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"Unable to write {path}: {e}", file=sys.stderr)
+            return
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # Least recently used artifacts are removed first, load() refreshes the mtime
+        entries = []
+        for name in os.listdir(self.directory):
+            path = f"{self.directory}/{name}"
+            if name.endswith(".npz") and path != keep:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
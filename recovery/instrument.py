@@ -0,0 +1,78 @@
+import sys
+import json
+import time
+import resource
+import platform
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.trace_memory = False
+        self.start = time.perf_counter()
+
+    def enable_memory_tracing(self):
+        self.trace_memory = True
+        tracemalloc.start()
+
+    def update_peaks(self):
+        # Nested phases reset the tracemalloc peak, so every open phase keeps its own maximum
+        _, peak = tracemalloc.get_traced_memory()
+        for frame in self.stack:
+            frame["peak_bytes"] = max(frame["peak_bytes"], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name, ntraces=None):
+        if self.trace_memory:
+            self.update_peaks()
+        frame = {"phase": " / ".join([f["phase"] for f in self.stack[-1:]] + [name]), "ntraces": ntraces, "peak_bytes": 0}
+        self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            seconds = time.perf_counter() - start
+            if self.trace_memory:
+                self.update_peaks()
+            self.stack.pop()
+            frame["start_s"] = start - self.start
+            frame["seconds"] = seconds
+            frame["traces_per_s"] = ntraces/seconds if ntraces is not None and seconds > 0 else None
+            if not self.trace_memory:
+                frame["peak_bytes"] = None
+            frame["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == "darwin" else 1024)
+            self.records.append(frame)
+
+    def summary(self):
+        print("#"*10 + " PHASES " + "#"*10)
+        for r in sorted(self.records, key=lambda r: r["start_s"]):
+            throughput = f", {r['traces_per_s']:.1f} traces/s" if r["traces_per_s"] is not None else ""
+            memory = f", peak {r['peak_bytes']/2**20:.1f} MiB" if r["peak_bytes"] is not None else ""
+            print(f"{r['phase']}: {r['seconds']:.3f}s{throughput}{memory}")
+        print("#"*10 + "#"*8 + "#"*10)
+
+    def write_report(self, file, arguments=None):
+        report = {
+            "arguments": arguments,
+            "machine": platform.platform(),
+            "python": platform.python_version(),
+            "total_seconds": time.perf_counter() - self.start,
+            "phases": sorted(self.records, key=lambda r: r["start_s"]),
+        }
+        try:
+            with open(file, 'w') as f:
+                json.dump(report, f, indent=1, default=str)
+            print(f"Wrote phase report to {file}.")
+        except OSError as e:
+            print(f"Unable to write {file}: {e}", file=sys.stderr)
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+def phase(name, ntraces=None):
+    return INSTRUMENTATION.phase(name, ntraces)
@@ -0,0 +1,48 @@
+import numpy as np
+from util import BitPlanes
+from stats import ClassCrossProducts, iter_chunks
+from attack import classify_traces, eval_attack
+
+
+def get_checkpoints(ntraces, checkpoints=None, start=10):
+    # Doubling numbers of traces up to all of them unless given explicitly
+    if not checkpoints:
+        checkpoints = [ntraces]
+        while start < ntraces:
+            checkpoints.append(start)
+            start *= 2
+    return sorted(set(min(c, ntraces) for c in checkpoints if c > 0))
+
+
+def template_learning_curve(pois, traces_profile, bcs_profile, traces_attack, nshares, checkpoints, name="", upper_bound=0.55):
+    # The POIs stay fixed, only the class sums and cross-products grow with every batch of profile traces
+    planes = BitPlanes.of(bcs_profile).planes(pois.get_num_bcs())
+    # Same variance convention as compute_template_from_bc
+    ddof = 0 if pois.get_num_pois_per_bit() == 1 else 1
+    products = ClassCrossProducts(pois.get_trace_locs().shape[:3], pois.get_num_pois_per_bit())
+    results = []
+    done = 0
+    for checkpoint in checkpoints:
+        for chunk in iter_chunks(traces_profile[done:checkpoint]):
+            products.update(pois.gather(chunk), planes[done:done+chunk.shape[0]])
+            done += chunk.shape[0]
+        if np.min(products.n) <= ddof:
+            print(f"{name}: some bits have a class without samples after {checkpoint} profile traces, skipping.")
+            continue
+        pois.set_template_arrays(*products.moments(ddof))
+        try:
+            res_is_success = classify_traces(traces_attack, pois, nshares, upper_bound)
+        except np.linalg.LinAlgError:
+            print(f"{name}: singular templates after {checkpoint} profile traces, skipping.")
+            continue
+        results.append((checkpoint,) + eval_attack(res_is_success, f"{name} {checkpoint} profile traces"))
+    pois.reset_template()
+    return results
+
+
+def print_learning_curve(results, name=""):
+    print("#"*10 + f" LEARNING CURVE {name.upper()} " + "#"*10)
+    print("traces, total, correct, ratio_correct, classified, ratio_classified")
+    for res in results:
+        print(", ".join(str(x) for x in res))
+    print()
@@ -7,15 +7,23 @@
 # to main_simulation or main_physical
 ##########################
 
+import os
 import sys
+import pstats
+import cProfile
 import argparse
-import numpy as np
 from datetime import datetime
 from poi import PoisCollection
-from util import read_traces, find_poi_manual
+from instrument import INSTRUMENTATION, phase
+from cache import ArtifactCache
+from archive import find_archives, read_traces_from_archive
+from util import SIMPLECOMPBITS, read_traces, find_poi_manual, set_plot_export
 from attack import attack, attack_one_trace
+from online import OnlineAttack, run_online
+from learning import get_checkpoints, template_learning_curve, print_learning_curve
 from plotting import plot_diff_means, plot_t_test_fail_nfail, plot_distribution_bc_horizontal, plot_distribution_bc_vertical
-from simulation import Simulator
+from simulation import create_simulator, iter_sweep, point_seed
+from results import EVAL_FIELDS, ResultStore, eval_record
 
 # #### SHARED PARAMS ####
 NSHARES = 4
@@ -23,6 +31,11 @@ NTRACES = 500
 NTRACES_PROFILE = 500
 NUM_BCS = 1
 POIS_PER_BIT = 1
+MIN_DISTANCE = 5
+WORKERS = 1
+REPORT_FILE = None
+RESULTS_FILE = None
+PROFILE_FILE = None
 
 PERFORM_PLOT_HORIZONTAL = False
 PERFORM_PLOT_VERTICAL = False
@@ -50,10 +63,21 @@ TEST_MODE = True
 
 TRACE_FILE = None
 BC_FILE = None
+PROFILE_TRACE_FILE = None
 
 TRACE_INDEX = 0
 MANUAL_POI_RANGE = None
 NO_POI_FINDING = False
+MMAP = False
+FROM_ARCHIVE = False
+CACHE_DIR = "../cache"
+CACHE_SIZE = 1024
+NO_CACHE = False
+ONLINE = False
+POLL_INTERVAL = 0.5
+IDLE_TIMEOUT = 60.0
+WARMUP = 20
+LEARNING_CURVE = None
 
 # #### SIMULATION PARAMS ####
 SIGMAS = [4.0]
@@ -70,6 +94,13 @@ def main():
     shared_parser.add_argument('--shares', choices=range(2, 20), type=int, default=4)
     shared_parser.add_argument('--ntraces', type=int, default=500)
     shared_parser.add_argument('--ntraces-profile', type=int, default=500)
+    shared_parser.add_argument('--plot-export', type=str, help="Save plots as PNG files in this directory instead of showing them", default=None)
+    shared_parser.add_argument('--plot-data', choices=['txt', 'npy'], help="Format of the raw plot data in ../plot_prints", default='txt')
+    shared_parser.add_argument('--workers', type=int, help="Number of worker processes", default=1)
+    shared_parser.add_argument('--results-file', type=str, help="JSON lines file the results are appended to, attacks already in it are skipped", default=None)
+    shared_parser.add_argument('--report', type=str, help="Write the per-phase timings to this JSON file", default=None)
+    shared_parser.add_argument('--trace-memory', action='store_true', help="Record the peak memory of every phase with tracemalloc")
+    shared_parser.add_argument('--profile', type=str, help="Run under cProfile and dump the stats to this file", default=None)
 
     parser = argparse.ArgumentParser(prog='Attacking Masked Comparisons')
     subparsers = parser.add_subparsers(required=True, dest='simulation_or_physical')
@@ -82,9 +113,20 @@ def main():
     parser_physical.add_argument('--no-test', action="store_true")
     parser_physical.add_argument('--trace-file', type=str, default=None)
     parser_physical.add_argument('--bc-file', type=str, default=None)
+    parser_physical.add_argument('--trace-file-profile', type=str, help="Trace file used for profiling with --separate-template or --online", default=None)
     parser_physical.add_argument('--trace-index', type=int, default=0)
     parser_physical.add_argument('--manual-poi-range', type=int, default=[450, 450], nargs=2)
     parser_physical.add_argument('--select-manual-poi', action='store_true')
+    parser_physical.add_argument('--mmap', action='store_true', help="Memory-map the trace and bc files instead of reading them")
+    parser_physical.add_argument('--from-archive', action='store_true', help="Stream the trace and bc files out of the ../traces/*.tar.gz bundles")
+    parser_physical.add_argument('--cache-dir', type=str, help="Directory for cached POIs and templates", default="../cache")
+    parser_physical.add_argument('--cache-size', type=int, help="Maximum size of the cache in MiB", default=1024)
+    parser_physical.add_argument('--no-cache', action='store_true', help="Always recompute POIs and templates")
+    parser_physical.add_argument('--online', action='store_true', help="Classify the traces of --trace-file while it is being captured, profiling on the profile trace file")
+    parser_physical.add_argument('--poll-interval', type=float, help="Seconds between checks for new traces in online mode", default=0.5)
+    parser_physical.add_argument('--idle-timeout', type=float, help="Stop the online mode after this many seconds without new traces", default=60.0)
+    parser_physical.add_argument('--learning-curve', type=int, nargs="*", help="Evaluate the template attack after these numbers of profile traces (doubling if none are given)", default=None)
+    parser_physical.add_argument('--warmup', type=int, help="Traces collected before the online vertical attack emits verdicts", default=20)
 
     parser_simulation = subparsers.add_parser('simulation', parents=[shared_parser])
     parser_simulation.add_argument("--seed", type=int, help="Simulation seed", default=42)
@@ -104,7 +146,9 @@ def main():
     global TRACE_FILE
     TRACE_FILE = args_dict.get('trace_file')
     global BC_FILE
-    BC_FILE = args_dict.get('trace_file')
+    BC_FILE = args_dict.get('bc_file')
+    global PROFILE_TRACE_FILE
+    PROFILE_TRACE_FILE = args_dict.get('trace_file_profile')
 
     global TRACE_INDEX
     TRACE_INDEX = args_dict.get('trace_index')
@@ -123,10 +167,24 @@ def main():
     POIS_PER_BIT = args_dict.get('pois')
     global NUM_BCS
     NUM_BCS = args_dict.get('bcs')
+    global WORKERS
+    WORKERS = args_dict.get('workers')
+    global REPORT_FILE
+    REPORT_FILE = args_dict.get('report')
+    global RESULTS_FILE
+    RESULTS_FILE = args_dict.get('results_file')
+    set_plot_export(args_dict.get('plot_export'), args_dict.get('plot_data'))
+    global PROFILE_FILE
+    PROFILE_FILE = args_dict.get('profile')
+    if args_dict.get('trace_memory'):
+        INSTRUMENTATION.enable_memory_tracing()
 
     if NTRACES_PROFILE % 2 != 0:
         print("Error: Number of profile traces have to be even for implementation reasons.")
         exit(1)
+    if args.simulation_or_physical == 'physical' and not 1 <= NUM_BCS <= SIMPLECOMPBITS:
+        print(f"Error: The bc files hold {SIMPLECOMPBITS} BCs per share, {NUM_BCS} requested.")
+        exit(1)
 
     global SEPARATE_TEMPLATE
     SEPARATE_TEMPLATE = args_dict.get('separate_template')
@@ -136,6 +194,29 @@ def main():
     MANUAL_POI_RANGE = args_dict.get('manual_poi_range')
     global NO_POI_FINDING
     NO_POI_FINDING = args_dict.get('select_manual_poi')
+    global MMAP
+    MMAP = args_dict.get('mmap')
+    global FROM_ARCHIVE
+    FROM_ARCHIVE = args_dict.get('from_archive')
+    global CACHE_DIR
+    CACHE_DIR = args_dict.get('cache_dir')
+    global CACHE_SIZE
+    CACHE_SIZE = args_dict.get('cache_size')
+    global NO_CACHE
+    NO_CACHE = args_dict.get('no_cache')
+    global ONLINE
+    ONLINE = args_dict.get('online')
+    global POLL_INTERVAL
+    POLL_INTERVAL = args_dict.get('poll_interval')
+    global IDLE_TIMEOUT
+    IDLE_TIMEOUT = args_dict.get('idle_timeout')
+    global WARMUP
+    WARMUP = args_dict.get('warmup')
+    global LEARNING_CURVE
+    LEARNING_CURVE = args_dict.get('learning_curve')
+    if ONLINE:
+        # The traces being captured carry no BCs, profiling always uses the profile trace file
+        SEPARATE_TEMPLATE = True
 
     plot_list = args_dict.get('plot')
     if plot_list is None:
@@ -187,12 +268,25 @@ def main():
         PERFORM_HORIZONTAL_ONE_TRACE = True
 
     print(f"Received arguments: {args_dict}")
-    if args.simulation_or_physical == 'physical':
-        main_physical()
+    if args.simulation_or_physical == 'physical' and ONLINE:
+        main_function = main_online
+    elif args.simulation_or_physical == 'physical':
+        main_function = main_physical
     elif args.simulation_or_physical == 'simulation':
-        main_simulation()
+        main_function = main_simulation
     else:
         raise ValueError
+    if PROFILE_FILE is not None:
+        profiler = cProfile.Profile()
+        profiler.runcall(main_function)
+        profiler.dump_stats(PROFILE_FILE)
+        print(f"Wrote profile to {PROFILE_FILE}.")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    else:
+        main_function()
+    INSTRUMENTATION.summary()
+    if REPORT_FILE is not None:
+        INSTRUMENTATION.write_report(REPORT_FILE, arguments=args_dict)
 
 
 def print_base_settings(sim):
@@ -207,13 +301,12 @@ def print_base_settings(sim):
         print("#"*10 + "#"*17 + "#"*10)
     print()
     print("#"*10 + " SETTINGS " + "#"*10)
-    print(f"{NSHARES=}, {DECIMATE=}, {OPT_LEVEL=}, {NTRACES=}, {NTRACES_PROFILE=}, {POIS_PER_BIT=}")
+    print(f"{NSHARES=}, {DECIMATE=}, {OPT_LEVEL=}, {NTRACES=}, {NTRACES_PROFILE=}, {NUM_BCS=}, {POIS_PER_BIT=}")
     print("#"*10 + "#"*10 + "#"*10)
     print()
 
 
-def read_all_traces(directory="traces"):
-    print("Reading traces..")
+def get_trace_files(directory="traces"):
     if TRACE_FILE is None:
         file = f"../{directory}/traces-order-{NSHARES}-decimate-{DECIMATE}-O{OPT_LEVEL}-{NTRACES}.bin"
     else:
@@ -222,16 +315,31 @@ def read_all_traces(directory="traces"):
         file_bc = f"../{directory}/bcs-order-{NSHARES}.bin"
     else:
         file_bc = BC_FILE
+    if PROFILE_TRACE_FILE is None:
+        file_profile = f"../{directory}/traces-order-{NSHARES}-decimate-{DECIMATE}-O{OPT_LEVEL}-{NTRACES_PROFILE}.bin"
+    else:
+        file_profile = PROFILE_TRACE_FILE
+    return file, file_bc, file_profile
+
+
+def read_all_traces(directory="traces"):
+    print("Reading traces..")
+    file, file_bc, file_profile = get_trace_files(directory)
     print(f"Trace file: {file}")
     print(f"BC file: {file_bc}")
+
+    def read(ntraces, file, file_bc, ignore_bc):
+        if FROM_ARCHIVE:
+            return read_traces_from_archive(ntraces, NSHARES, find_archives(f"../{directory}"), file=file, file_bc=file_bc, ignore_bc=ignore_bc)
+        return read_traces(ntraces, NSHARES, file=file, file_bc=file_bc, ignore_bc=ignore_bc, mmap=MMAP)
+
     try:
-        traces, bcs = read_traces(NTRACES, NSHARES, file=file, file_bc=file_bc, ignore_bc=SEPARATE_TEMPLATE)
+        traces, bcs = read(NTRACES, file=file, file_bc=file_bc, ignore_bc=SEPARATE_TEMPLATE)
         if SEPARATE_TEMPLATE:
-            file_profile = f"../{directory}/traces-order-{NSHARES}-decimate-{DECIMATE}-O{OPT_LEVEL}-{NTRACES_PROFILE}.bin"
             file_bc_profile = file_bc
             print(f"Profile trace file: {file_profile}")
             print(f"Profile BC file: {file_bc_profile}")
-            traces_profile, bcs_profile = read_traces(NTRACES_PROFILE, NSHARES, file=file_profile, file_bc=file_bc_profile, ignore_bc=False)
+            traces_profile, bcs_profile = read(NTRACES_PROFILE, file=file_profile, file_bc=file_bc_profile, ignore_bc=False)
             print("Attack traces for profiled and non-profiled attacks are the same.")
             print(f"Profiled attacks use additional traces from {file_profile}.")
             traces_attack = traces
@@ -244,7 +352,7 @@ def read_all_traces(directory="traces"):
             bcs_profile = bcs[:NTRACES_PROFILE]
             traces_attack = traces[NTRACES_PROFILE:]
             bcs_attack = bcs[NTRACES_PROFILE:]
-    except OSError as e:
+    except (OSError, EOFError) as e:
         print(f"Unable to read trace or bc file: {e}", file=sys.stderr)
         print("Are you sure the traces for the selected setting exist?")
         return
@@ -293,19 +401,81 @@ def perform_plots(traces, bcs, pois, trace_idx):
     return pois
 
 
-def perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs_profile, trace_idx):
+def get_cache():
+    if NO_CACHE:
+        return None
+    return ArtifactCache(CACHE_DIR, max_bytes=CACHE_SIZE << 20)
+
+
+def get_profile_key(cache):
+    file, file_bc, file_profile = get_trace_files()
+    files = [file_profile if SEPARATE_TEMPLATE else file, file_bc]
+    if FROM_ARCHIVE:
+        return cache.key(find_archives(), members=[os.path.basename(f) for f in files], nshares=NSHARES, ntraces_profile=NTRACES_PROFILE, separate_template=SEPARATE_TEMPLATE)
+    return cache.key(files, nshares=NSHARES, ntraces_profile=NTRACES_PROFILE, separate_template=SEPARATE_TEMPLATE)
+
+
+def find_all_pois_cached(traces_profile, bcs_profile):
+    cache = get_cache()
+    if cache is not None:
+        key = cache.key(bcs=NUM_BCS, pois_per_bit=POIS_PER_BIT, min_distance=MIN_DISTANCE, selection="top-k-nms", profile=get_profile_key(cache))
+        artifacts = cache.load("pois", key)
+        if artifacts is not None:
+            print(f"Loaded POIs from {cache.path('pois', key)}.")
+            return PoisCollection.from_trace_locs(artifacts["trace_locs"])
+    pois = PoisCollection.find_all_pois(traces_profile, bcs_profile, num_bcs=NUM_BCS, num_pois_per_bit=POIS_PER_BIT, min_distance=MIN_DISTANCE)
+    if cache is not None:
+        cache.store("pois", key, trace_locs=pois.get_trace_locs())
+    return pois
+
+
+def compute_template_from_bc_cached(pois, traces_profile, bcs_profile):
+    cache = get_cache()
+    if cache is not None:
+        key = cache.key(arrays=[pois.get_trace_locs()], bcs=pois.get_num_bcs(), pois_per_bit=pois.get_num_pois_per_bit(), profile=get_profile_key(cache))
+        artifacts = cache.load("template", key)
+        if artifacts is not None:
+            print(f"Loaded templates from {cache.path('template', key)}.")
+            pois.set_template_arrays(artifacts["means"], artifacts["covs"])
+            return
+    pois.compute_template_from_bc(traces_profile, bcs_profile)
+    if cache is not None:
+        template = pois.get_batch_template()
+        cache.store("template", key, means=template.means, covs=template.covs)
+
+
+def get_physical_config(attack_name):
+    file, file_bc, file_profile = get_trace_files()
+    return {"mode": "physical", "attack": attack_name, "trace_file": file, "bc_file": file_bc, "profile_trace_file": file_profile if SEPARATE_TEMPLATE else None,
+            "nshares": NSHARES, "ntraces": NTRACES, "ntraces_profile": NTRACES_PROFILE, "decimate": DECIMATE, "optlevel": OPT_LEVEL,
+            "nbcs": NUM_BCS, "npois": POIS_PER_BIT, "test_mode": TEST_MODE}
+
+
+def run_recorded(store, attack_name, run):
+    if store is None:
+        return run()
+    config = get_physical_config(attack_name)
+    if store.is_done(config):
+        print(f"Skipping the {attack_name} attack, its result is already in {store.file}.")
+        return store.get(config)
+    res = run()
+    store.append(config, eval_record(res))
+    return res
+
+
+def perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs_profile, trace_idx, store=None):
     ###########
     if PERFORM_TEMPLATE_ONE_TRACE:
         def templ_func_0():
-            return pois.compute_template_from_bc(traces_profile, bcs_profile)
+            return compute_template_from_bc_cached(pois, traces_profile, bcs_profile)
         attack_one_trace(traces_attack, bcs_attack, trace_idx, pois, name=f"Single trial template {NSHARES}-{NTRACES}-{DECIMATE}", template_function=templ_func_0)
     ###########
 
     ###########
     if PERFORM_TEMPLATE:
         def templ_func_1():
-            return pois.compute_template_from_bc(traces_profile, bcs_profile)
-        attack(traces_attack, pois, NSHARES, f"Template attack {NSHARES}-{NTRACES}-{DECIMATE}", test_mode=TEST_MODE, template_function=templ_func_1)
+            return compute_template_from_bc_cached(pois, traces_profile, bcs_profile)
+        run_recorded(store, "template", lambda: attack(traces_attack, pois, NSHARES, f"Template attack {NSHARES}-{NTRACES}-{DECIMATE}", test_mode=TEST_MODE, template_function=templ_func_1, workers=WORKERS))
     ###########
 
     ###########
@@ -319,7 +489,7 @@ def perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs
     if PERFORM_VERTICAL:
         def templ_func_3():
             return pois.compute_vertical_auto_template(traces)
-        attack(traces_attack, pois, NSHARES, f"Vertical attack: {NSHARES}-{NTRACES}-{DECIMATE}", test_mode=TEST_MODE, template_function=templ_func_3)
+        run_recorded(store, "vertical", lambda: attack(traces_attack, pois, NSHARES, f"Vertical attack: {NSHARES}-{NTRACES}-{DECIMATE}", test_mode=TEST_MODE, template_function=templ_func_3, workers=WORKERS))
     ###########
 
     ###########
@@ -331,7 +501,7 @@ def perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs
 
     ###########
     if PERFORM_HORIZONTAL:
-        attack(traces, pois, NSHARES, f"Horizontal attack: {NSHARES}-{NTRACES}-{DECIMATE}", build_single_trace_template=PoisCollection.compute_horizontal_auto_template, test_mode=TEST_MODE, template_function=None)
+        run_recorded(store, "horizontal", lambda: attack(traces, pois, NSHARES, f"Horizontal attack: {NSHARES}-{NTRACES}-{DECIMATE}", build_single_trace_template=PoisCollection.compute_horizontal_auto_template, build_batch_template=PoisCollection.compute_horizontal_auto_template_batch, test_mode=TEST_MODE, template_function=None, workers=WORKERS))
     ###########
 
 
@@ -340,60 +510,129 @@ def main_physical():
 
     trace_idx = TRACE_INDEX
 
-    traces_profile, bcs_profile, traces_attack, bcs_attack, traces, bcs = read_all_traces()
+    with phase("read traces", ntraces=2*NTRACES):
+        traces_profile, bcs_profile, traces_attack, bcs_attack, traces, bcs = read_all_traces()
 
     pois = None
     ###########
     if not NO_POI_FINDING:
         print("Finding pois..")
-        pois = PoisCollection.find_all_pois(traces_profile, bcs_profile, num_pois_per_bit=POIS_PER_BIT)
+        with phase("find pois", ntraces=len(traces_profile)):
+            pois = find_all_pois_cached(traces_profile, bcs_profile)
         print(f"Found {pois.get_num_pois_per_bit()} POIs per bit for {pois.get_num_bcs()} BCs and {pois.get_num_shares()} shares.")
         print()
     ###########
 
-    pois_2 = perform_plots(traces, bcs, pois, trace_idx)
+    with phase("plots"):
+        pois_2 = perform_plots(traces, bcs, pois, trace_idx)
     if NO_POI_FINDING:
         pois = pois_2
-    perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs_profile, trace_idx)
+    store = ResultStore(RESULTS_FILE) if RESULTS_FILE is not None else None
+    perform_attacks(pois, traces, traces_attack, bcs_attack, traces_profile, bcs_profile, trace_idx, store)
+
+    if LEARNING_CURVE is not None:
+        name = f"Template attack {NSHARES}-{NTRACES}-{DECIMATE}"
+        checkpoints = get_checkpoints(len(traces_profile), LEARNING_CURVE)
+        print(f"Learning curve over {checkpoints} profile traces with the POIs of all {len(traces_profile)}..")
+        with phase("learning curve", ntraces=len(traces_profile)):
+            results = template_learning_curve(pois, traces_profile, bcs_profile, traces_attack, NSHARES, checkpoints, name=name)
+        print_learning_curve(results, name)
+
+
+def main_online():
+    print_base_settings(sim=False)
+
+    file, file_bc, file_profile = get_trace_files()
+    print(f"Profile trace file: {file_profile}")
+    print(f"Profile BC file: {file_bc}")
+    try:
+        with phase("read traces", ntraces=2*NTRACES_PROFILE):
+            traces_profile, bcs_profile = read_traces(NTRACES_PROFILE, NSHARES, file=file_profile, file_bc=file_bc, ignore_bc=False, mmap=MMAP)
+    except (OSError, EOFError) as e:
+        print(f"Unable to read trace or bc file: {e}", file=sys.stderr)
+        print("Are you sure the profile traces for the selected setting exist?")
+        return
+
+    print("Finding pois..")
+    with phase("find pois", ntraces=len(traces_profile)):
+        pois = find_all_pois_cached(traces_profile, bcs_profile)
+    print()
+
+    attacks = []
+    if PERFORM_TEMPLATE:
+        print("Building templates..")
+        compute_template_from_bc_cached(pois, traces_profile, bcs_profile)
+        attacks.append(OnlineAttack(f"Online template attack {NSHARES}-{DECIMATE}", pois, template=pois.get_batch_template()))
+        pois.reset_template()
+    if PERFORM_VERTICAL:
+        attacks.append(OnlineAttack(f"Online vertical attack {NSHARES}-{DECIMATE}", pois, warmup=WARMUP))
+    if PERFORM_HORIZONTAL:
+        attacks.append(OnlineAttack(f"Online horizontal attack {NSHARES}-{DECIMATE}", pois, build_template=PoisCollection.compute_horizontal_auto_template_batch))
+    if not attacks:
+        print("Error: Select the online attacks with --attack.")
+        return
+
+    try:
+        with phase("online attack"):
+            return run_online(file, attacks, poll_interval=POLL_INTERVAL, idle_timeout=IDLE_TIMEOUT, test_mode=TEST_MODE)
+    except (OSError, EOFError) as e:
+        print(f"Unable to read trace file: {e}", file=sys.stderr)
+
+
+def get_results_file(prefix):
+    if RESULTS_FILE is not None:
+        return RESULTS_FILE
+    dt_string = datetime.now().strftime("%d%m%Y-%H%M%S")
+    return f"../results/{prefix}_{dt_string}.jsonl"
+
+
+def get_simulation_config(point, attack_name):
+    sigma, nshares, nbcs, npois, ntraces = point
+    return {"mode": "simulation", "attack": attack_name, "sigma": sigma, "nshares": nshares, "nbcs": nbcs, "npois": npois, "traces": ntraces,
+            "ntraces_profile": NTRACES_PROFILE, "eval_traces": EVAL_TRACES, "seed": SEED, "stream": "point"}
 
 
 def main_simulation():
     results = {}
-    now = datetime.now()
-    dt_string = now.strftime("%d%m%Y-%h%m%s")
 
     print_base_settings(sim=True)
 
     if POIS_PER_BIT > 1:
         print("ERROR: MULTIPLE POIs ARE NOT MODELED CORRECTLY. ABORTING.")
         exit(1)
-    for sigma in SIGMAS:
-        print(f"Seeding with {SEED}.")
-        np.random.seed(SEED)
-        print(f"Creating simulator with {sigma=}, {NUM_BCS=}, {NSHARES=}, {POIS_PER_BIT=}, {2*NTRACES=}, {EVAL_TRACES=}..")
-        sim = Simulator(sigma, NUM_BCS, NSHARES, POIS_PER_BIT)
-        print("Finding POIs..")
-        sim.find_pois()
-        print("Recording traces..")
-        sim.record_traces(2*NTRACES)
-        sim.finish_recording_phase()
-        if PERFORM_PLOT_VERTICAL:
-            print("Plotting vertical..")
-            plot_distribution_bc_vertical(sim.traces, sim.pois, sim.bcs)
-        if PERFORM_PLOT_HORIZONTAL:
-            print("Plotting horizontal..")
-            plot_distribution_bc_horizontal(sim.traces[0], sim.pois, sim.bcs[0])
-        print("Executing attacks..")
-        res = sim.execute_attacks(number_of_traces=EVAL_TRACES, profile_traces=NTRACES_PROFILE, template=PERFORM_TEMPLATE, vertical=PERFORM_VERTICAL, horizontal=PERFORM_HORIZONTAL)
+    points = [(sigma, NSHARES, NUM_BCS, POIS_PER_BIT, 2*NTRACES) for sigma in SIGMAS]
+    seeds = [point_seed(SEED, point) for point in points]
+    if PERFORM_PLOT_VERTICAL or PERFORM_PLOT_HORIZONTAL:
+        for point, seed in zip(points, seeds):
+            sigma, nshares, nbcs, npois, ntraces = point
+            sim = create_simulator(sigma, nbcs, nshares, npois, ntraces, seed)
+            if PERFORM_PLOT_VERTICAL:
+                print("Plotting vertical..")
+                plot_distribution_bc_vertical(sim.traces, sim.pois, sim.bcs)
+            if PERFORM_PLOT_HORIZONTAL:
+                print("Plotting horizontal..")
+                plot_distribution_bc_horizontal(sim.traces[0], sim.pois, sim.bcs[0])
+
+    store = ResultStore(get_results_file("results"))
+    attack_names = [name for name, perform in (("template", PERFORM_TEMPLATE), ("vertical", PERFORM_VERTICAL), ("horizontal", PERFORM_HORIZONTAL)) if perform]
+    # One task per point and attack; the simulator of a point is rebuilt from its seed, so every attack sees the same traces
+    tasks = [(point, seed, attack_name) for point, seed in zip(points, seeds) for attack_name in attack_names if not store.is_done(get_simulation_config(point, attack_name))]
+    print(f"Running {len(tasks)} simulated attacks seeded from {SEED} with {WORKERS} workers, {EVAL_TRACES=}, skipping {len(points)*len(attack_names) - len(tasks)} already in {store.file}..")
+    attack_args = [{"number_of_traces": EVAL_TRACES, "profile_traces": NTRACES_PROFILE, "template": attack_name == "template", "vertical": attack_name == "vertical", "horizontal": attack_name == "horizontal"} for _, _, attack_name in tasks]
+    with phase("simulation sweep", ntraces=sum(point[-1] for point, _, _ in tasks)):
+        for idx, res in iter_sweep([t[0] for t in tasks], [t[1] for t in tasks], attack_args, workers=WORKERS):
+            point, _, attack_name = tasks[idx]
+            store.append(get_simulation_config(point, attack_name), eval_record(res[f"results_{attack_name}"]))
+
+    for point in points:
+        sigma, nshares, nbcs, npois, ntraces = point
+        res = {"sigma": sigma, "traces": ntraces, "nshares": nshares, "nbcs": nbcs, "npois": npois}
+        for attack_name in attack_names:
+            record = store.get(get_simulation_config(point, attack_name))
+            res[f"results_{attack_name}"] = tuple(record[f] for f in EVAL_FIELDS)
         results[sigma] = res
     print(results)
-    results_file = f"../results/results_{dt_string}.txt"
-    try:
-        with open(results_file, 'w') as f:
-            f.write(str(results))
-    except OSError as e:
-        print(f"Unable to write {results_file}: {e}", file=sys.stderr)
-        print("Are you sure the results directory exists?")
+    print(f"Results are in {store.file}.")
 
     return results
 
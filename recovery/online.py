@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import numpy as np
+from poi import BatchTemplate, split_by_mean, compute_class_moments
+from attack import classify_batch, eval_attack
+from archive import read_exact
+
+
+def wait_for_size(file, size, poll_interval=0.5, idle_timeout=60.0):
+    start = time.monotonic()
+    while not os.path.exists(file) or os.path.getsize(file) < size:
+        if time.monotonic() - start > idle_timeout:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+def tail_traces(file, poll_interval=0.5, idle_timeout=60.0, chunk_traces=256):
+    # Yields (trace_num, samples_per_trace) from the header first, then every complete pair of traces
+    # appended by the capture script, until the announced number of traces is reached or the file stops growing
+    if not wait_for_size(file, 8, poll_interval, idle_timeout):
+        raise EOFError(f"{file} has no header after {idle_timeout}s")
+    with open(file, 'rb') as f:
+        trace_num = 2*int.from_bytes(read_exact(f, 4), byteorder="big")
+        samples_per_trace = int.from_bytes(read_exact(f, 4), byteorder="big")
+        yield trace_num, samples_per_trace
+        pair_bytes = 2*8*samples_per_trace
+        done = 0
+        while done < trace_num:
+            complete = 2*((os.fstat(f.fileno()).st_size - 8)//pair_bytes)
+            count = min(trace_num, complete, done + chunk_traces) - done
+            if count <= 0:
+                if not wait_for_size(file, 8 + (done//2 + 1)*pair_bytes, poll_interval, idle_timeout):
+                    print(f"No new traces in {file} for {idle_timeout}s, stopping after {done} of {trace_num} traces.")
+                    return
+                continue
+            data = read_exact(f, 8*count*samples_per_trace)
+            yield np.frombuffer(data, dtype=np.float64).reshape((count, samples_per_trace))
+            done += count
+
+
+class OnlineAttack:
+    def __init__(self, name, pois, template=None, build_template=None, warmup=20, upper_bound=0.55):
+        # Without a fixed template or a per-trace builder the vertical template is refit as traces arrive
+        self.name = name
+        self.pois = pois
+        self.template = template
+        self.build_template = build_template
+        self.warmup = warmup
+        self.upper_bound = upper_bound
+        self.obs = []
+        self.res_is_success = []
+
+    def is_vertical(self):
+        return self.template is None and self.build_template is None
+
+    def update(self, traces):
+        obs = self.pois.gather(traces)
+        if self.is_vertical():
+            # The split of every POI column is a clustering, so it is redone over the POI samples of all
+            # traces seen so far; verdicts already emitted are kept
+            self.obs.append(obs)
+            obs = np.concatenate(self.obs)
+            self.obs = [obs]
+            if obs.shape[0] < self.warmup or obs.shape[0] == len(self.res_is_success):
+                return []
+            is_1 = split_by_mean(obs, axis=0)
+            template = BatchTemplate(*compute_class_moments(obs, is_1, axis=0))
+            obs = obs[len(self.res_is_success):]
+        elif self.build_template is not None:
+            template = self.build_template(self.pois, obs)
+        else:
+            template = self.template
+        if obs.shape[0] == 0:
+            return []
+        bits, _, _ = template.apply(obs)
+        verdicts = classify_batch(bits, self.upper_bound)
+        self.res_is_success += verdicts
+        return verdicts
+
+    def finish(self, samples_per_trace):
+        # Traces still waiting for the warmup are classified with the statistics there are
+        if not self.is_vertical():
+            return []
+        self.warmup = 0
+        return self.update(np.empty((0, samples_per_trace)))
+
+
+def report_verdicts(attack, classify, mtime):
+    names = {True: "success", False: "failure", None: "unclassified"}
+    start = len(attack.res_is_success)
+    verdicts = classify()
+    if not verdicts:
+        return
+    latency = time.time() - mtime
+    for idx_tr, suc in enumerate(verdicts, start):
+        print(f"{attack.name}: trace {idx_tr} {names[suc]} ({latency:.2f}s after capture)")
+    counts = {name: sum(1 for suc in attack.res_is_success if names[suc] == name) for name in names.values()}
+    print(f"{attack.name}: {len(attack.res_is_success)} traces, {counts['success']} successes, {counts['failure']} failures, {counts['unclassified']} unclassified")
+    sys.stdout.flush()
+
+
+def run_online(file, attacks, poll_interval=0.5, idle_timeout=60.0, test_mode=True):
+    print(f"Waiting for traces in {file}..")
+    chunks = tail_traces(file, poll_interval, idle_timeout)
+    trace_num, samples_per_trace = next(chunks)
+    print(f"Capture announces {trace_num} traces with {samples_per_trace} samples.")
+    for chunk in chunks:
+        mtime = os.path.getmtime(file)
+        for attack in attacks:
+            report_verdicts(attack, lambda: attack.update(chunk), mtime)
+    for attack in attacks:
+        report_verdicts(attack, lambda: attack.finish(samples_per_trace), os.path.getmtime(file))
+
+    results = []
+    for attack in attacks:
+        if test_mode:
+            results.append(eval_attack(attack.res_is_success, attack.name))
+        else:
+            print(attack.res_is_success)
+            results.append(attack.res_is_success)
+    return results
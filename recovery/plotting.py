@@ -1,8 +1,9 @@
 import numpy as np
 import scipy
 import matplotlib.pyplot as plt
-from util import bits, bits_2, print_plt, plot_traces, compute_auto_correlation, take_nth, find_poi_separate_samples
+from util import BitPlanes, bits, bits_2, print_plt, plot_traces, show_plot, compute_auto_correlation, take_nth, find_poi_separate_samples
 from poi import Loc
+from stats import accumulate_classes, fixed_vs_fixed_t_test, iter_chunks, merge_all, welch_t_test
 
 
 def plot_distribution_bc_horizontal(trace, pois, bcs=None, idx_bc=0, idx_poi=0, inverse_bin_fac=2):
@@ -36,7 +37,7 @@ def plot_distribution_bc_horizontal(trace, pois, bcs=None, idx_bc=0, idx_poi=0,
         print()
         print_plt(bins1, hist1, name="horizontal_1")
     plt.title(f"Horizontal distribution with {len(locs) + len(locs_1)} samples")
-    plt.show()
+    show_plot("horizontal_distribution")
 
 
 def plot_distribution_bc_vertical(traces, pois, bcs=None, trace_idx=0, idx_bc=0, share=0, bit=0, idx_poi=0, inverse_bin_fac=4, plot_loc=None):
@@ -73,7 +74,7 @@ def plot_distribution_bc_vertical(traces, pois, bcs=None, trace_idx=0, idx_bc=0,
         print_plt(bins1, hist1, name="vertical_1.txt")
         # plt.plot([mean, mean], [0, 1])
     plt.title(f"Vertical distribution with {len(traces)} samples")
-    plt.show()
+    show_plot("vertical_distribution")
 
 
 def plot_modeled_vertical_distributions(num, sigma):
@@ -103,26 +104,26 @@ def plot_modeled_vertical_distributions(num, sigma):
     plt.plot(bins[:-1], hist)
     print_plt(bins0, hist0)
     plt.plot(bins0[:-1], hist0)
-    plt.show()
+    show_plot("modeled_vertical_distribution")
 
 
 def plot_diff_means(traces, bcs, bc_idx=0, share=0, bit=0, pois=None):
+    poi = None
+    if pois is not None:
+        poi = pois.get_poi(bc_idx, share, bit).locs
     if bcs is not None:
-        poi = None
-        if pois is not None:
-            poi = pois.get_poi(bc_idx, share, bit).locs
-        loc = Loc(bc_idx, share, bit)
-        m0, m1, _, _, _, _ = loc.compute_mean_and_var(traces, bcs)
-        plot_traces([np.mean(traces, axis=0), m0-m1], ["Mean", f"Difference of Means {bc_idx=} {share=} {bit=}"], locs=poi)
+        labels = BitPlanes.of(bcs).get_bit(bc_idx, share, bit)
+        moments_0, moments_1 = accumulate_classes(iter_chunks(traces), labels)
+        mean = merge_all([moments_0, moments_1]).mean
+        plot_traces([mean, moments_0.mean-moments_1.mean], ["Mean", f"Difference of Means {bc_idx=} {share=} {bit=}"], locs=poi)
     else:
-        poi = None
-        if pois is not None:
-            poi = pois.get_poi(bc_idx, share, bit).locs
-        plot_traces([np.mean(traces, axis=0)], ["Mean"], locs=poi)
+        labels = np.zeros(traces.shape[0], dtype=int)
+        moments, = accumulate_classes(iter_chunks(traces), labels, nclasses=1)
+        plot_traces([moments.mean], ["Mean"], locs=poi)
 
 
 def plot_auto_correlation(traces, bcs, pois):
-    cors = compute_auto_correlation(traces)
+    cors = compute_auto_correlation(traces, max_len=traces.shape[1], start=0)
     loc0, others0, _ = cors[0]
     locs_raw = [loc0] + take_nth(others0, 0)
     locs = list(map(lambda x: Loc(0, 0, 0, x), locs_raw))
@@ -144,21 +145,21 @@ def plot_separated_pois(traces, bcs=None, pois=None):
 
 
 def plot_t_test_fail_nfail(traces, pois=None):
-    idc_0 = list(range(0, traces.shape[0], 2))
-    idc_1 = list(range(1, traces.shape[0], 2))
-    plot_t_test(traces, idc_0, idc_1, pois)
+    t_stat, moments = fixed_vs_fixed_t_test(iter_chunks(traces), traces.shape[0])
+    plot_t_stat(moments.mean, t_stat, pois)
 
 
 def plot_t_test(traces, idc_0, idc_1, pois=None):
-    t_0 = traces[idc_0, :]
-    t_1 = traces[idc_1, :]
-    mean_sucs = np.mean(t_0, axis=0)
-    mean_fail = np.mean(t_1, axis=0)
-    mean_diff = mean_sucs-mean_fail
-    assert t_0.shape[0] + t_1.shape[0] == traces.shape[0]
-    corrected_var_sucs = np.var(t_0, axis=0)/t_0.shape[0]
-    corrected_var_fail = np.var(t_1, axis=0)/t_1.shape[0]
-    t_stat = mean_diff/np.sqrt(corrected_var_fail+corrected_var_sucs)
+    assert len(idc_0) + len(idc_1) == traces.shape[0]
+    labels = np.full(traces.shape[0], -1)
+    labels[idc_0] = 0
+    labels[idc_1] = 1
+    moments_0, moments_1 = accumulate_classes(iter_chunks(traces), labels)
+    t_stat = welch_t_test(moments_0, moments_1)
+    plot_t_stat(merge_all([moments_0, moments_1]).mean, t_stat, pois)
+
+
+def plot_t_stat(mean, t_stat, pois=None):
     leakage_points = np.where(t_stat >= 4.5)[0]
     print(f"{leakage_points=}")
     if pois is not None:
@@ -167,4 +168,4 @@ def plot_t_test(traces, idc_0, idc_1, pois=None):
                 if poi.trace_loc in leakage_points:
                     print(f"WARNING: {poi} is at a leaking point!")
 
-    plot_traces([np.mean(traces, axis=0), t_stat], ["mean", "t-statistic"], sharey=False, sharex=True)
+    plot_traces([mean, t_stat], ["mean", "t-statistic"], sharey=False, sharex=True)
@@ -1,7 +1,100 @@
-import copy
 import numpy as np
 import scipy
-from util import bits, take_nth, separate_normals
+from util import BitPlanes, take_nth, separate_normals
+
+# Bytes of intermediate arrays the POI search and template estimation may hold per block of BCs
+MEMORY_BUDGET = 1 << 29
+
+
+def compute_class_means(traces, labels, sums=None):
+    # One matrix product yields the class-1 sums of every label column at once
+    n_1 = np.sum(labels, axis=0)
+    n_0 = labels.shape[0] - n_1
+    sums_1 = labels.T @ traces
+    if sums is None:
+        sums = np.sum(traces, axis=0)
+    sums_0 = sums - sums_1
+    return sums_0 / n_0[:, None], sums_1 / n_1[:, None]
+
+
+def select_pois(diffs, num_pois=1, min_distance=5):
+    # Greedy top-k of |diff| per row, later POIs keep at least min_distance to the earlier ones.
+    # Every POI suppresses at most 2*min_distance-1 samples, so a pool of the C largest suffices.
+    min_distance = max(1, min_distance)
+    scores = np.abs(diffs)
+    pool_size = min(scores.shape[1], (num_pois - 1)*(2*min_distance - 1) + 1)
+    pool = np.argpartition(scores, -pool_size, axis=1)[:, -pool_size:]
+    order = np.argsort(-np.take_along_axis(scores, pool, axis=1), axis=1, kind='stable')
+    pool = np.take_along_axis(pool, order, axis=1)
+    valid = np.ones(pool.shape, dtype=bool)
+    rows = np.arange(pool.shape[0])
+    locs = np.full((pool.shape[0], num_pois), -1, dtype=np.int64)
+    for k in range(num_pois):
+        first = np.argmax(valid, axis=1)
+        found = valid[rows, first]
+        locs[found, k] = pool[rows, first][found]
+        valid &= ~found[:, None] | (np.abs(pool - locs[:, k, None]) >= min_distance)
+    return locs
+
+
+def bc_blocks(num_bcs, bytes_per_bc, memory_budget=MEMORY_BUDGET):
+    block = max(1, memory_budget//max(1, bytes_per_bc))
+    for start in range(0, num_bcs, block):
+        yield slice(start, min(num_bcs, start + block))
+
+
+def split_by_mean(obs, axis):
+    # Vectorized separate_normals along `axis`, the last axis holds the POIs of a bit
+    mean = np.mean(obs, axis=axis, keepdims=True)
+    above = obs >= mean
+    below = obs <= mean
+    mean_0 = np.sum(obs, axis=axis, keepdims=True, where=above)/np.sum(above, axis=axis, keepdims=True)
+    mean_1 = np.sum(obs, axis=axis, keepdims=True, where=below)/np.sum(below, axis=axis, keepdims=True)
+    all_0 = np.all(obs > mean, axis=-1)
+    all_1 = np.all(obs < mean, axis=-1)
+    closer_0 = np.sum(np.abs(obs-mean_0), axis=-1) < np.sum(np.abs(obs-mean_1), axis=-1)
+    is_0 = all_0 | (~all_1 & closer_0)
+    return ~is_0
+
+
+def compute_class_moments(obs, is_1, axis, ddof=1):
+    # Means and covariances of both classes over `axis`
+    obs = np.moveaxis(obs, axis, -2)
+    is_1 = np.moveaxis(is_1, axis, -1)
+    means = []
+    covs = []
+    for mask in (~is_1, is_1):
+        weights = mask[..., None].astype(np.float64)
+        n = np.sum(weights, axis=-2)
+        mean = np.sum(obs*weights, axis=-2)/n
+        centered = (obs - mean[..., None, :])*weights
+        cov = np.matmul(np.swapaxes(centered, -1, -2), centered)/(n[..., None] - ddof)
+        means.append(mean)
+        covs.append(cov)
+    return np.stack(means, axis=-2), np.stack(covs, axis=-3)
+
+
+class BatchTemplate:
+    def __init__(self, means, covs):
+        # means: (..., 2, npois) and covs: (..., 2, npois, npois) for classes 0 and 1
+        self.means = np.asarray(means, dtype=np.float64)
+        self.covs = np.asarray(covs, dtype=np.float64)
+        self.inv_covs = np.linalg.inv(self.covs)
+        _, self.log_dets = np.linalg.slogdet(self.covs)
+
+    def get_num_pois(self):
+        return self.means.shape[-1]
+
+    def log_likelihood(self, obs):
+        diff = obs[..., None, :] - self.means
+        mahalanobis = np.sum(diff * np.matmul(self.inv_covs, diff[..., None])[..., 0], axis=-1)
+        return -0.5*(mahalanobis + self.log_dets + self.get_num_pois()*np.log(2*np.pi))
+
+    def apply(self, obs):
+        ll = self.log_likelihood(obs)
+        ll_0, ll_1 = ll[..., 0], ll[..., 1]
+        bits = (ll_1 > ll_0).astype(np.uint8)
+        return bits, ll_0, ll_1
 
 
 class Loc:
@@ -15,10 +108,9 @@ class Loc:
         return f"{self.bc_index=}, {self.share_index=}, {self.bit_index=}, {self.trace_loc=}"
 
     def get_by_bc(self, traces, bcs):
-        bit = self.bit_index
-        bc = np.array([bits(bc_e)[bit] for bc_e in bcs[:, self.bc_index, self.share_index]])
-        indices_0 = np.argwhere(bc == 0)[:, 0]
-        indices_1 = np.argwhere(bc == 1)[:, 0]
+        bc = BitPlanes.of(bcs).get_bit(self.bc_index, self.share_index, self.bit_index)
+        indices_0 = np.flatnonzero(~bc)
+        indices_1 = np.flatnonzero(bc)
         assert indices_0.shape[0] + indices_1.shape[0] == traces.shape[0]
         return indices_0, indices_1
 
@@ -77,7 +169,7 @@ class Pois:
             elif ev1 >= 2:
                 indices_1.append(i)
             else:
-                if diffs[0] < diffs[1]:
+                if sum(take_nth(diffs, 0)) < sum(take_nth(diffs, 1)):
                     indices_0.append(i)
                 else:
                     indices_1.append(i)
@@ -127,6 +219,9 @@ class Pois:
         bit = 1 if v1 > v0 else 0
         return bit, v0, v1
 
+    def set_template_arrays(self, means, covs):
+        self.template = ((list(means[0]), covs[0].tolist()), (list(means[1]), covs[1].tolist()))
+
     def __str__(self):
         return f"POI at {self.locs}"
 
@@ -142,160 +237,183 @@ class Pois:
     @classmethod
     def find_pois(cls, traces, bcs, loc, num_pois=1, min_distance=5):
         means0, means1, _, _, _, _ = loc.compute_mean_and_var(traces, bcs)
-        diff = means0 - means1
-        sort = np.argsort(np.abs(diff), axis=0)
-        found = 0
-        locs = []
-        for i in range(1, min_distance+1):
-            x = sort[-i]
-            for p in locs:
-                if abs(x - p.trace_loc) < min_distance:
-                    continue
-            loc_cur = copy.deepcopy(loc)
-            loc_cur.trace_loc = x
-            locs.append(loc_cur)
-            found += 1
-            if found >= num_pois:
-                break
-        if found < num_pois:
+        return cls.from_diff(means0 - means1, loc, num_pois, min_distance)
+
+    @classmethod
+    def from_diff(cls, diff, loc, num_pois=1, min_distance=5):
+        trace_locs = select_pois(diff[None], num_pois, min_distance)[0]
+        if np.any(trace_locs < 0):
             print("Did not find sufficiently many POIs")
-        return cls(locs)
+        return cls([Loc(loc.bc_index, loc.share_index, loc.bit_index, int(x)) for x in trace_locs if x >= 0])
 
 
 class PoisCollection:
-    def __init__(self, num_bcs, shares):
-        self.pois = [[[None for _ in range(32)] for _ in range(shares)] for _ in range(num_bcs)]
+    def __init__(self, num_bcs, shares, num_pois_per_bit=1):
+        # Trace locations of all POIs, -1 marks bits without POIs
+        self.trace_locs = np.full((num_bcs, shares, 32, num_pois_per_bit), -1, dtype=np.int64)
+        # Stacked templates: means (..., 2, npois) and covs (..., 2, npois, npois)
+        self.means = None
+        self.covs = None
 
     def len(self):
-        i = 0
-
-        def count(_):
-            nonlocal i
-            i += 1
-        self.map(count)
-        return i
+        return self.get_num_bcs()*self.get_num_shares()*32
 
     def get_pois_list(self):
-        ls = [pbit for pbc in self.pois for pshares in pbc for pbit in pshares]
+        ls = [self.get_poi(idx_bc, share, bit) for idx_bc in range(self.get_num_bcs()) for share in range(self.get_num_shares()) for bit in range(32)]
         return ls
 
     def get_num_bcs(self):
-        return len(self.pois)
+        return self.trace_locs.shape[0]
 
     def get_num_shares(self):
-        return len(self.pois[0])
+        return self.trace_locs.shape[1]
 
     def get_num_pois_per_bit(self):
-        return self.pois[0][0][0].get_num_pois()
+        return self.trace_locs.shape[3]
 
     def get_poi(self, idx_bc, share, bit):
-        return self.pois[idx_bc][share][bit]
+        trace_locs = self.trace_locs[idx_bc, share, bit]
+        if trace_locs[0] < 0:
+            return None
+        poi = Pois([Loc(idx_bc, share, bit, int(x)) for x in trace_locs])
+        if self.means is not None:
+            poi.set_template_arrays(self.means[idx_bc, share, bit], self.covs[idx_bc, share, bit])
+        return poi
 
     def set_pois(self, idx_bc, share, bit, poi):
-        self.pois[idx_bc][share][bit] = poi
+        assert poi.get_num_pois() == self.get_num_pois_per_bit()
+        self.trace_locs[idx_bc, share, bit] = poi.trace_locs
 
-    def reset_template(self):
-        self.map(Pois.reset_template)
+    def get_trace_locs(self):
+        return self.trace_locs
 
-    def compute_template_from_bc(self, traces, bcs):
-        self.map(Pois.compute_template_from_bc, traces, bcs)
+    def check_trace_locs(self):
+        # Indexing with -1 would silently read the last sample of every trace
+        missing = np.any(self.trace_locs < 0, axis=3)
+        if np.any(missing):
+            idx_bc, share, bit = np.argwhere(missing)[0]
+            raise ValueError(f"{np.sum(missing)} of {missing.size} bits have no POIs (first: bc {idx_bc}, share {share}, bit {bit})")
 
-    def compute_vertical_auto_template(self, traces):
-        self.map(Pois.compute_vertical_auto_template, traces)
+    def gather(self, traces, block=slice(None)):
+        self.check_trace_locs()
+        return np.asarray(traces[:, self.trace_locs[block]])
 
-    def compute_auto_template_simple(self, traces):
-        self.map(Pois.compute_auto_template_simple, traces)
-
-    def compute_horizontal_auto_template(self, trace):
-        for bc_idx in range(self.get_num_bcs()):
-            self.compute_horizontal_auto_template_bc(trace, bc_idx)
+    def reset_template(self):
+        self.means = None
+        self.covs = None
 
-    def compute_horizontal_auto_template_bc(self, trace, bc_idx):
+    def set_template_arrays(self, means, covs):
+        shape = self.trace_locs.shape[:3]
         num_pois = self.get_num_pois_per_bit()
-        pois = [poi_bit for pois_share in self.pois[bc_idx] for poi_bit in pois_share]
-        locs = [[p.locs[poi_idx].trace_loc for p in pois] for poi_idx in range(num_pois)]
-        obs = np.array([[trace[loc] for loc in locs[poi_idx]] for poi_idx in range(num_pois)])
-
-        separated_loc_dists = []
+        self.means = np.array(np.broadcast_to(means, shape + (2, num_pois)))
+        self.covs = np.array(np.broadcast_to(covs, shape + (2, num_pois, num_pois)))
 
-        for poi_idx in range(num_pois):
-            samples = obs[poi_idx]
-            mean, (_, mean_0, sigma_0), (_, mean_1, sigma_1) = separate_normals(samples)
-            separated_loc_dists.append((mean, (mean_0, sigma_0), (mean_1, sigma_1)))
+    def empty_template_arrays(self):
+        shape = self.trace_locs.shape[:3]
+        num_pois = self.get_num_pois_per_bit()
+        return np.empty(shape + (2, num_pois)), np.empty(shape + (2, num_pois, num_pois))
+
+    def get_batch_template(self):
+        assert self.means is not None
+        self.check_trace_locs()
+        return BatchTemplate(self.means, self.covs)
+
+    def get_bc_blocks(self, ntraces, memory_budget=MEMORY_BUDGET):
+        # compute_class_moments holds about four copies of the observations of a block, plus its bit planes
+        return bc_blocks(self.get_num_bcs(), 4*8*ntraces*self.trace_locs[0].size + ntraces*self.trace_locs[0, ..., 0].size, memory_budget)
+
+    def compute_template_from_bc(self, traces, bcs, memory_budget=MEMORY_BUDGET):
+        bcs = BitPlanes.of(bcs)
+        # A single POI per bit is modeled with the biased variance, like np.var
+        ddof = 0 if self.get_num_pois_per_bit() == 1 else 1
+        means, covs = self.empty_template_arrays()
+        for block in self.get_bc_blocks(traces.shape[0], memory_budget):
+            obs = self.gather(traces, block)
+            means[block], covs[block] = compute_class_moments(obs, bcs.planes(block.stop, start=block.start), axis=0, ddof=ddof)
+        self.set_template_arrays(means, covs)
+
+    def compute_vertical_auto_template(self, traces, memory_budget=MEMORY_BUDGET):
+        # Every POI column is split over all traces at once
+        means, covs = self.empty_template_arrays()
+        for block in self.get_bc_blocks(traces.shape[0], memory_budget):
+            obs = self.gather(traces, block)
+            is_1 = split_by_mean(obs, axis=0)
+            means[block], covs[block] = compute_class_moments(obs, is_1, axis=0)
+        self.set_template_arrays(means, covs)
 
-        indices_0 = []
-        indices_1 = []
+    def compute_auto_template_simple(self, traces):
+        self.map(Pois.compute_auto_template_simple, traces)
 
-        for i in range(len(pois)):
-            ev0 = 1
-            ev1 = 1
-            diffs = []
-            for poi_idx, (mean, (mean_0, sigma_0), (mean_1, sigma_1)) in enumerate(separated_loc_dists):
-                ob = obs[poi_idx][i]
-                # Does not work as 1-bits are not normally distributed
-                # v0 = scipy.stats.norm(mean_0, sigma_0).pdf(obs)
-                # v1 = scipy.stats.norm(mean_1, sigma_1).pdf(obs)
-                v0 = 2 if ob > mean else 0
-                v1 = 2 if ob < mean else 0
-                ev0 *= v0
-                ev1 *= v1
-                diffs.append((abs(ob-mean_0), abs(ob-mean_1)))
-            if ev0 >= 2:
-                indices_0.append(i)
-            elif ev1 >= 2:
-                indices_1.append(i)
-            else:
-                if sum(take_nth(diffs, 0)) < sum(take_nth(diffs, 1)):
-                    indices_0.append(i)
-                else:
-                    indices_1.append(i)
+    def compute_horizontal_auto_template(self, trace):
+        template = self.compute_horizontal_auto_template_batch(self.gather(trace[None]))
+        self.set_template_arrays(template.means[0], template.covs[0])
 
-        obs_0 = obs[:, indices_0]
-        obs_1 = obs[:, indices_1]
-        means_0 = [None for _ in range(num_pois)]
-        means_1 = [None for _ in range(num_pois)]
-        covs_0 = [[None for _ in range(num_pois)] for _ in range(num_pois)]
-        covs_1 = [[None for _ in range(num_pois)] for _ in range(num_pois)]
-        for i in range(num_pois):
-            mean_0 = np.mean(obs_0[i])
-            mean_1 = np.mean(obs_1[i])
-            means_0[i] = mean_0
-            means_1[i] = mean_1
-            for j in range(num_pois):
-                obs_i_0 = obs_0[i]
-                obs_i_1 = obs_1[i]
-                obs_j_0 = obs_0[j]
-                obs_j_1 = obs_1[j]
-                cov_0 = np.cov(obs_i_0, obs_j_0)[0][1]
-                cov_1 = np.cov(obs_i_1, obs_j_1)[0][1]
-                covs_0[i][j] = cov_0
-                covs_1[i][j] = cov_1
-        for poi in pois:
-            poi.set_template(((means_0, np.array(covs_0)), (means_1, np.array(covs_1))))
+    def compute_horizontal_auto_template_batch(self, obs):
+        # One template per trace and BC, estimated from the POIs of all its shares and bits
+        ntraces, num_bcs = obs.shape[:2]
+        obs_bc = obs.reshape((ntraces, num_bcs, -1, obs.shape[-1]))
+        is_1 = split_by_mean(obs_bc, axis=2)
+        means, covs = compute_class_moments(obs_bc, is_1, axis=2)
+        return BatchTemplate(means[:, :, None, None], covs[:, :, None, None])
 
     def apply_template(self, trace):
-        return self.map(Pois.apply_template, trace)
+        bits, ll_0, ll_1 = self.get_batch_template().apply(self.gather(trace[None]))
+        rec = zip(bits[0].tolist(), np.exp(ll_0[0]).tolist(), np.exp(ll_1[0]).tolist())
+        return [[list(zip(*rec_share)) for rec_share in zip(*rec_bc)] for rec_bc in rec]
+
+    def get_trace_chunk_size(self, memory_budget=MEMORY_BUDGET):
+        # Building a horizontal template takes a few dozen copies of the observations of a chunk
+        return max(1, memory_budget//(32*8*self.trace_locs.size))
+
+    def apply_template_batch(self, traces, template=None, chunk_size=None, build_template=None, memory_budget=MEMORY_BUDGET):
+        if template is None and build_template is None:
+            template = self.get_batch_template()
+        if chunk_size is None:
+            chunk_size = self.get_trace_chunk_size(memory_budget)
+        results = []
+        for start in range(0, traces.shape[0], chunk_size):
+            obs = self.gather(traces[start:start+chunk_size])
+            if build_template is not None:
+                template = build_template(self, obs)
+            results.append(template.apply(obs))
+        bits, ll_0, ll_1 = (np.concatenate(r) for r in zip(*results))
+        return bits, ll_0, ll_1
 
     def map(self, fn, *args, **kargs):
         results = []
-        for bc_pois in self.pois:
+        for idx_bc in range(self.get_num_bcs()):
             results_bc = []
-            for share_pois in bc_pois:
+            for share in range(self.get_num_shares()):
                 results_share = []
-                for bit_pois in share_pois:
-                    res = fn(bit_pois, *args, **kargs)
+                for bit in range(32):
+                    res = fn(self.get_poi(idx_bc, share, bit), *args, **kargs)
                     results_share.append(res)
                 results_bc.append(results_share)
             results.append(results_bc)
         return results
 
     @classmethod
-    def find_all_pois(cls, traces, bcs, num_bcs=1, num_pois_per_bit=1, min_distance=5):
-        pois = cls(num_bcs, bcs.shape[2])
-        for idx_bc in range(num_bcs):
-            for share in range(bcs.shape[2]):
-                for bit_idx in range(32):
-                    loc = Loc(idx_bc, share, bit_idx)
-                    pois_loc = Pois.find_pois(traces, bcs, loc, num_pois_per_bit, min_distance)
-                    pois.set_pois(idx_bc, share, bit_idx, pois_loc)
+    def from_trace_locs(cls, trace_locs):
+        pois = cls(*trace_locs.shape[:2], trace_locs.shape[3])
+        pois.trace_locs[:] = trace_locs
+        return pois
+
+    @classmethod
+    def find_all_pois(cls, traces, bcs, num_bcs=1, num_pois_per_bit=1, min_distance=5, memory_budget=MEMORY_BUDGET):
+        nshares = bcs.shape[2]
+        assert num_bcs <= bcs.shape[1], f"Only {bcs.shape[1]} BCs available, {num_bcs} requested"
+        pois = cls(num_bcs, nshares, num_pois_per_bit)
+        bcs = BitPlanes.of(bcs)
+        traces = np.asarray(traces)
+        # The trace sums are shared by all blocks, each block of BCs costs one matrix product
+        sums = np.sum(traces, axis=0)
+        # Per BC: the class means, their difference and the float labels of the block
+        for block in bc_blocks(num_bcs, 8*nshares*32*(5*traces.shape[1] + traces.shape[0]), memory_budget):
+            means_0, means_1 = compute_class_means(traces, bcs.labels(block.stop, start=block.start), sums)
+            diffs = means_0 - means_1
+            del means_0, means_1
+            trace_locs = select_pois(diffs, num_pois_per_bit, min_distance)
+            pois.trace_locs[block] = trace_locs.reshape(pois.trace_locs[block].shape)
+        if np.any(pois.trace_locs < 0):
+            print("Did not find sufficiently many POIs")
         return pois
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# ##### DESCRIPTION ######
+# Append-only store with one JSON record per line and per (configuration, attack).
+# Records are written as soon as an attack finishes, so an interrupted sweep
+# resumes by passing the same --results-file again. Summarize a store with
+#   ./results.py ../results/results_[date].jsonl
+##########################
+
+import os
+import sys
+import json
+from datetime import datetime
+
+EVAL_FIELDS = ("total", "correct", "ratio_correct", "classified", "ratio_classified")
+
+
+def eval_record(res):
+    # eval_attack returns the fields above, attacks outside test mode return the verdicts
+    if isinstance(res, tuple):
+        return dict(zip(EVAL_FIELDS, res))
+    return {"verdicts": res}
+
+
+def read_records(file):
+    records = []
+    with open(file, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A crash while appending leaves at most one partial line
+                continue
+    return records
+
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+class ResultStore:
+    def __init__(self, file):
+        self.file = file
+        try:
+            records = read_records(file)
+        except OSError:
+            records = []
+        self.results = {config_key(r["config"]): r["result"] for r in records}
+        if self.results:
+            print(f"Loaded {len(self.results)} results from {file}.")
+
+    def is_done(self, config):
+        return config_key(config) in self.results
+
+    def get(self, config):
+        return self.results.get(config_key(config))
+
+    def append(self, config, result):
+        record = {"time": datetime.now().isoformat(timespec="seconds"), "config": config, "result": result}
+        try:
+            os.makedirs(os.path.dirname(self.file) or ".", exist_ok=True)
+            with open(self.file, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"Unable to write {self.file}: {e}", file=sys.stderr)
+        self.results[config_key(config)] = result
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} [results.jsonl]")
+        exit(1)
+    records = read_records(sys.argv[1])
+    keys = sorted({k for r in records for k in r["config"]})
+    fields = [f for f in EVAL_FIELDS if any(f in r["result"] for r in records)]
+    print(", ".join(keys + fields))
+
+    def sort_key(record):
+        values = [record["config"].get(k) for k in keys]
+        return [(0, v, "") if isinstance(v, (int, float)) else (1, 0, str(v)) for v in values]
+    for r in sorted(records, key=sort_key):
+        print(", ".join([str(r["config"].get(k)) for k in keys] + [str(r["result"].get(f)) for f in fields]))
+
+
+if __name__ == "__main__":
+    main()
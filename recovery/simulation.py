@@ -1,11 +1,12 @@
 import numpy as np
-from poi import Loc, Pois, PoisCollection
-from util import bits, bits_2, share_value
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from poi import PoisCollection
+from util import BitPlanes, bits, bits_2, hamming_weight, share_value
 from attack import attack
 
 
 class Simulator:
-    def __init__(self, sigma, num_bcs, num_shares, pois_per_bit):
+    def __init__(self, sigma, num_bcs, num_shares, pois_per_bit, rng=None):
         sigma_bound = 0.0001
         assert sigma >= sigma_bound, f"Sigma must be greater than {sigma_bound}"
         self.sigma = sigma
@@ -17,21 +18,13 @@ class Simulator:
         self.bcs = []
         self.traces = []
         self.pois = None
+        self.rng = np.random.default_rng() if rng is None else rng
 
     def find_pois(self):
         assert self.pois is None
-        self.pois = PoisCollection(self.num_bcs, self.num_shares)
-        trace_loc = 0
-        for bc_idx in range(self.num_bcs):
-            for share_idx in range(self.num_shares):
-                for bit_idx in range(32):
-                    locs = []
-                    for poi_idx in range(self.pois_per_bit):
-                        loc = Loc(bc_idx, share_idx, bit_idx, trace_loc=trace_loc)
-                        locs.append(loc)
-                        trace_loc += 1
-                    poi = Pois(locs)
-                    self.pois.set_pois(bc_idx, share_idx, bit_idx, poi)
+        # The simulated trace holds exactly the POIs, in (bc, share, bit, poi) order
+        trace_locs = np.arange(self.total_points).reshape((self.num_bcs, self.num_shares, 32, self.pois_per_bit))
+        self.pois = PoisCollection.from_trace_locs(trace_locs)
         assert self.pois.len() == self.num_bcs*self.num_shares*32
         assert self.pois.len() == self.total_points//self.pois_per_bit
 
@@ -40,18 +33,18 @@ class Simulator:
         bcs = []
         for bc_idx in range(self.num_bcs):
             if dec_fail:
-                shares = [np.random.randint(0, 1 << 32) for _ in range(self.num_shares)]
+                shares = [int(self.rng.integers(0, 1 << 32)) for _ in range(self.num_shares)]
             else:
-                shares = share_value(0, self.num_shares)
+                shares = share_value(0, self.num_shares, rng=self.rng)
             bcs.append(shares)
-            r = np.random.randint(0, 1 << 64, dtype=np.uint64)
+            r = int(self.rng.integers(0, 1 << 64, dtype=np.uint64))
             hw = sum(bits_2(r))
             for share_idx, share in enumerate(shares):
                 current_share_bits = bits(share)
                 for bit_idx in range(32):
                     hw_cur = 0 if current_share_bits[bit_idx] == 0 else hw
                     for poi_idx in range(self.pois_per_bit):
-                        obs = np.random.normal(hw_cur, self.sigma)
+                        obs = self.rng.normal(hw_cur, self.sigma)
                         trace.append(obs)
         assert len(trace) == self.total_points
         if append:
@@ -59,11 +52,26 @@ class Simulator:
             self.bcs.append(bcs)
         return trace, bcs
 
+    def record_traces_batch(self, num_traces, append=True):
+        # Odd traces are decryption failures, their BCs are uniformly random
+        dec_fail = np.arange(num_traces) & 1 == 1
+        shape = (num_traces, self.num_bcs)
+        shares = self.rng.integers(0, 1 << 32, size=shape + (self.num_shares,), dtype=np.uint32)
+        shares[~dec_fail, :, -1] = np.bitwise_xor.reduce(shares[~dec_fail, :, :-1], axis=-1)
+        hw = hamming_weight(self.rng.integers(0, 1 << 64, size=shape, dtype=np.uint64))
+        leakage = BitPlanes(shares).planes()*hw[:, :, None, None]
+        leakage = np.repeat(leakage[..., None], self.pois_per_bit, axis=-1).reshape((num_traces, -1))
+        traces = leakage + self.rng.normal(0, self.sigma, size=leakage.shape)
+        assert traces.shape[1] == self.total_points
+        if append:
+            self.traces.extend(traces)
+            self.bcs.extend(shares)
+        return traces, shares
+
     def record_traces(self, num_traces, verbose=True):
-        for i in range(num_traces):
-            self.record_trace(i & 1 == 1)
-            if verbose:
-                print(f"{i}/{num_traces}" + " "*20, end='\r')
+        self.record_traces_batch(num_traces)
+        if verbose:
+            print(f"Recorded {num_traces} traces.")
 
     def finish_recording_phase(self):
         self.traces = np.array(self.traces)
@@ -83,17 +91,7 @@ class Simulator:
         if attack_name == "template":
             print("######## SIMULATED TEMPLATE ATTACK ########")
             print(f"Sampling {2*profile_traces} template traces..")
-            template_traces = []
-            template_bcs = []
-            for _ in range(profile_traces):
-                trace0, bc0 = self.record_trace(False, append=False)
-                trace1, bc1 = self.record_trace(True, append=False)
-                template_traces.append(trace0)
-                template_traces.append(trace1)
-                template_bcs.append(bc0)
-                template_bcs.append(bc1)
-            template_traces = np.array(template_traces)
-            template_bcs = np.array(template_bcs)
+            template_traces, template_bcs = self.record_traces_batch(2*profile_traces, append=False)
 
             def tmpl_func():
                 return self.pois.compute_template_from_bc(template_traces, template_bcs)
@@ -103,9 +101,45 @@ class Simulator:
                 return self.pois.compute_vertical_auto_template(self.traces)
             total, correct, ratio_correct, classified, ratio_classified = attack(self.traces, self.pois, self.num_shares, f"Simulated vertical auto template attack {self.num_shares}-{len(self.traces)}-{self.sigma}", template_function=tmpl_func, number_of_traces=number_of_traces)
         elif attack_name == "auto_horizontal":
-            total, correct, ratio_correct, classified, ratio_classified = attack(self.traces, self.pois, self.num_shares, f"Simulated horizontal auto template attack {self.num_shares}-{len(self.traces)}-{self.sigma}", build_single_trace_template=PoisCollection.compute_horizontal_auto_template, number_of_traces=number_of_traces, template_function=None)
+            total, correct, ratio_correct, classified, ratio_classified = attack(self.traces, self.pois, self.num_shares, f"Simulated horizontal auto template attack {self.num_shares}-{len(self.traces)}-{self.sigma}", build_single_trace_template=PoisCollection.compute_horizontal_auto_template, build_batch_template=PoisCollection.compute_horizontal_auto_template_batch, number_of_traces=number_of_traces, template_function=None)
         else:
             raise ValueError("Unknown attack")
         if reset:
             self.pois.reset_template()
         return total, correct, ratio_correct, classified, ratio_classified
+
+
+def create_simulator(sigma, num_bcs, num_shares, pois_per_bit, num_traces, seed):
+    print(f"Creating simulator with {sigma=}, {num_bcs=}, {num_shares=}, {pois_per_bit=}, {num_traces=}..")
+    sim = Simulator(sigma, num_bcs, num_shares, pois_per_bit, rng=np.random.default_rng(seed))
+    print("Finding POIs..")
+    sim.find_pois()
+    print("Recording traces..")
+    sim.record_traces(num_traces)
+    sim.finish_recording_phase()
+    return sim
+
+
+def simulate_point(point, seed, attack_args):
+    sigma, num_shares, num_bcs, pois_per_bit, num_traces = point
+    sim = create_simulator(sigma, num_bcs, num_shares, pois_per_bit, num_traces, seed)
+    print("Executing attacks..")
+    return sim.execute_attacks(**attack_args)
+
+
+def point_seed(seed, point):
+    # The stream is derived from the point itself, so a sigma gets the same traces whatever else is swept
+    sigma, num_shares, num_bcs, pois_per_bit, num_traces = point
+    return np.random.SeedSequence([seed, int(np.float64(sigma).view(np.uint64)), num_shares, num_bcs, pois_per_bit, num_traces])
+
+
+def iter_sweep(points, seeds, attack_args, workers=1):
+    # Yields (index, result) as soon as a point finishes, in completion order
+    if workers <= 1:
+        yield from enumerate(map(simulate_point, points, seeds, attack_args))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(simulate_point, *args): idx for idx, args in enumerate(zip(points, seeds, attack_args))}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class RunningMoments:
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    @classmethod
+    def from_samples(cls, samples):
+        moments = cls(samples.shape[1:])
+        moments.n = samples.shape[0]
+        if moments.n > 0:
+            moments.mean = np.mean(samples, axis=0)
+            moments.m2 = np.sum((samples - moments.mean)**2, axis=0)
+        return moments
+
+    def update(self, samples):
+        return self.merge(RunningMoments.from_samples(samples))
+
+    def merge(self, other):
+        # Chan et al.: combine two partial results without revisiting the samples
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*(other.n/n)
+        self.m2 = self.m2 + other.m2 + delta**2*(self.n*other.n/n)
+        self.n = n
+        return self
+
+    def var(self, ddof=0):
+        return self.m2/(self.n - ddof)
+
+
+class ClassCrossProducts:
+    def __init__(self, shape, num_pois, nclasses=2):
+        # Counts, sums and cross-products of the POI observations per class, any number of traces can be added later
+        self.n = np.zeros(shape + (nclasses,))
+        self.sums = np.zeros(shape + (nclasses, num_pois))
+        self.cross = np.zeros(shape + (nclasses, num_pois, num_pois))
+
+    def update(self, obs, labels):
+        # obs: (ntraces, ..., num_pois), labels: (ntraces, ...) with the class of every observation
+        for cls in range(self.n.shape[-1]):
+            weights = (labels == cls)[..., None].astype(np.float64)
+            weighted = obs*weights
+            self.n[..., cls] += np.sum(weights[..., 0], axis=0)
+            self.sums[..., cls, :] += np.sum(weighted, axis=0)
+            self.cross[..., cls, :, :] += np.einsum('n...i,n...j->...ij', weighted, obs)
+        return self
+
+    def moments(self, ddof=1):
+        means = self.sums/self.n[..., None]
+        covs = (self.cross - self.n[..., None, None]*means[..., :, None]*means[..., None, :])/(self.n[..., None, None] - ddof)
+        return means, covs
+
+
+def iter_chunks(traces, chunk_size=256):
+    for start in range(0, traces.shape[0], chunk_size):
+        yield np.asarray(traces[start:start+chunk_size])
+
+
+def accumulate_classes(chunks, labels, nclasses=2):
+    moments = None
+    start = 0
+    for chunk in chunks:
+        if moments is None:
+            moments = [RunningMoments(chunk.shape[1:]) for _ in range(nclasses)]
+        labels_chunk = labels[start:start+chunk.shape[0]]
+        for cls, moments_cls in enumerate(moments):
+            moments_cls.update(chunk[labels_chunk == cls])
+        start += chunk.shape[0]
+    assert start == len(labels), f"{start} != {len(labels)}"
+    return moments
+
+
+def merge_all(moments):
+    merged = RunningMoments(moments[0].mean.shape)
+    for m in moments:
+        merged.merge(m)
+    return merged
+
+
+def welch_t_test(moments_0, moments_1):
+    corrected_var_0 = moments_0.var()/moments_0.n
+    corrected_var_1 = moments_1.var()/moments_1.n
+    return (moments_0.mean - moments_1.mean)/np.sqrt(corrected_var_0 + corrected_var_1)
+
+
+def fixed_vs_fixed_t_test(chunks, ntraces):
+    # Traces alternate between decryption success (even) and failure (odd)
+    labels = np.arange(ntraces) % 2
+    moments_0, moments_1 = accumulate_classes(chunks, labels)
+    return welch_t_test(moments_0, moments_1), merge_all([moments_0, moments_1])
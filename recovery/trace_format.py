@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# ##### DESCRIPTION ######
+# Compact trace container: a versioned header followed by int16 ADC codes
+# (or float32 samples) stored in fixed-size chunks of traces.
+# Samples are decoded as code*scale + offset.
+# Convert existing captures with
+#   ./trace_format.py convert traces.bin traces.mct [--dtype int16|float32]
+##########################
+
+import sys
+import struct
+import argparse
+import numpy as np
+
+MAGIC = b"MCTR"
+VERSION = 1
+# magic, version, dtype code, number of traces, samples per trace, traces per chunk, scale, offset
+HEADER = struct.Struct(">4sHHIIIdd")
+DTYPES = {1: np.dtype('<i2'), 2: np.dtype('<f4')}
+DTYPE_CODES = {"int16": 1, "float32": 2}
+
+
+def is_container(file):
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TraceContainer:
+    def __init__(self, file):
+        with open(file, 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+        magic, version, dtype_code, trace_num, samples_per_trace, chunk_traces, scale, offset = header
+        if magic != MAGIC or version != VERSION or dtype_code not in DTYPES:
+            raise ValueError(f"{file} is not a version {VERSION} trace container")
+        self.file = file
+        self.chunk_traces = chunk_traces
+        self.scale = scale
+        self.offset = offset
+        self.codes = np.memmap(file, mode='r', offset=HEADER.size, dtype=DTYPES[dtype_code],
+                               shape=(trace_num, samples_per_trace))
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def ndim(self):
+        return self.codes.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def decode(self, codes):
+        return codes.astype(np.float64)*self.scale + self.offset
+
+    def __getitem__(self, key):
+        # Slicing traces stays lazy, everything else is decoded on the fly
+        if isinstance(key, slice) and key.step in (None, 1):
+            view = object.__new__(TraceContainer)
+            view.__dict__.update(self.__dict__)
+            view.codes = self.codes[key]
+            return view
+        return self.decode(self.codes[key])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.read() if dtype is None else self.read().astype(dtype)
+
+    def iter_chunks(self):
+        for start in range(0, self.shape[0], self.chunk_traces):
+            yield self.decode(self.codes[start:start+self.chunk_traces])
+
+    def read(self):
+        traces = np.empty(self.shape)
+        for start in range(0, self.shape[0], self.chunk_traces):
+            traces[start:start+self.chunk_traces] = self.decode(self.codes[start:start+self.chunk_traces])
+        return traces
+
+
+def write_container(file, chunks, trace_num, samples_per_trace, dtype="int16", scale=1.0, offset=0.0, chunk_traces=256):
+    np_dtype = DTYPES[DTYPE_CODES[dtype]]
+    written = 0
+    with open(file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], trace_num, samples_per_trace, chunk_traces, scale, offset))
+        for chunk in chunks:
+            codes = (chunk - offset)/scale
+            if np_dtype.kind == 'i':
+                info = np.iinfo(np_dtype)
+                codes = np.clip(np.rint(codes), info.min, info.max)
+            f.write(codes.astype(np_dtype).tobytes())
+            written += chunk.shape[0]
+    assert written == trace_num, f"{written} != {trace_num}"
+
+
+def convert_bin(file, file_out, dtype="int16", scale=None, offset=None, chunk_traces=256):
+    with open(file, 'rb') as f:
+        trace_num = 2*int.from_bytes(f.read(4), byteorder="big")
+        samples_per_trace = int.from_bytes(f.read(4), byteorder="big")
+    traces = np.memmap(file, mode='r', offset=8, dtype=np.float64, shape=(trace_num, samples_per_trace))
+    chunks = [slice(start, start+chunk_traces) for start in range(0, trace_num, chunk_traces)]
+    if dtype == "float32":
+        scale, offset = 1.0, 0.0
+    elif scale is None or offset is None:
+        # Spread the observed range over the int16 codes
+        low = min(np.min(traces[c]) for c in chunks)
+        high = max(np.max(traces[c]) for c in chunks)
+        offset = float(high + low)/2
+        scale = float(high - low)/(2*np.iinfo(np.int16).max) if high > low else 1.0
+    print(f"Converting {trace_num} traces with {samples_per_trace} samples to {dtype} ({scale=}, {offset=})..")
+    write_container(file_out, (traces[c] for c in chunks), trace_num, samples_per_trace, dtype, scale, offset, chunk_traces)
+    error = max(np.max(np.abs(TraceContainer(file_out)[c] - traces[c])) for c in chunks)
+    print(f"Wrote {file_out}, maximum absolute error {error}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Trace container tools')
+    subparsers = parser.add_subparsers(required=True, dest='command')
+    parser_convert = subparsers.add_parser('convert', help="Convert a .bin capture to a trace container")
+    parser_convert.add_argument('file')
+    parser_convert.add_argument('file_out')
+    parser_convert.add_argument('--dtype', choices=list(DTYPE_CODES), default="int16")
+    parser_convert.add_argument('--scale', type=float, help="Sample value of one ADC code, e.g. 0.0009765625 (1/1024) for ChipWhisperer captures", default=None)
+    parser_convert.add_argument('--offset', type=float, help="Sample value of ADC code 0, e.g. -0.5 for ChipWhisperer captures", default=None)
+    parser_convert.add_argument('--chunk-traces', type=int, default=256)
+    args = parser.parse_args()
+    try:
+        convert_bin(args.file, args.file_out, args.dtype, args.scale, args.offset, args.chunk_traces)
+    except OSError as e:
+        print(f"Unable to convert {args.file}: {e}", file=sys.stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
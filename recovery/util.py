@@ -1,13 +1,16 @@
+import os
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
+from trace_format import TraceContainer, is_container
 
 SIMPLECOMPBITS = 272
 
 
-def share_value(bc, nshares):
-    shares = [np.random.randint(0, 1 << 32) for _ in range(nshares-1)]
+def share_value(bc, nshares, rng=None):
+    randint = np.random.randint if rng is None else rng.integers
+    shares = [int(randint(0, 1 << 32)) for _ in range(nshares-1)]
     bc_shared = bc
     for share in shares:
         bc_shared ^= share
@@ -31,24 +34,75 @@ def bits(num):
     return bits
 
 
+def hamming_weight(values):
+    values = np.ascontiguousarray(values)
+    raw = values.view(np.uint8).reshape(values.shape + (values.itemsize,))
+    return np.sum(np.unpackbits(raw, axis=-1), axis=-1)
+
+
+class BitPlanes:
+    # Only the packed bcs are kept, bits are unpacked for the BCs a caller asks for
+    def __init__(self, bcs):
+        self.bcs = bcs if isinstance(bcs, np.ndarray) else np.asarray(bcs)
+        self.shape = self.bcs.shape
+
+    @classmethod
+    def of(cls, bcs):
+        if isinstance(bcs, cls):
+            return bcs
+        return cls(bcs)
+
+    def planes(self, stop=None, start=0):
+        bcs = np.ascontiguousarray(self.bcs[:, start:stop], dtype='<u4')
+        raw = bcs.view(np.uint8).reshape(bcs.shape + (4,))
+        return np.unpackbits(raw, axis=-1, bitorder='little').view(bool)
+
+    def get_bit(self, bc_index, share_index, bit_index):
+        return (np.asarray(self.bcs[:, bc_index, share_index]) >> bit_index) & 1 == 1
+
+    def labels(self, stop, dtype=np.float64, start=0):
+        planes = self.planes(stop, start)
+        return planes.reshape((planes.shape[0], -1)).astype(dtype)
+
+
 def take_nth(ls, n):
     return list(map(lambda x: x[n], ls))
 
 
-def read_traces(ntraces, nshares, file, file_bc, ignore_bc):
+def read_traces(ntraces, nshares, file, file_bc, ignore_bc, mmap=False):
     traces = []
     with open(file, 'rb') as f:
         trace_num = 2*int.from_bytes(f.read(4), byteorder="big")
         samples_per_trace = int.from_bytes(f.read(4), byteorder="big")
-    traces = np.fromfile(file, offset=8, dtype=np.float64)
-    trace_num_2 = traces.shape[0]//samples_per_trace
-    assert trace_num == trace_num_2
-    assert trace_num == 2*ntraces, f"{trace_num} != {ntraces}"
-    print(f"Read {traces.shape} floats.")
+    if is_container(file):
+        traces = TraceContainer(file)
+        trace_num = traces.shape[0]
+        assert trace_num == 2*ntraces, f"{trace_num} != {ntraces}"
+        if mmap:
+            print(f"Mapped {traces.shape} samples, decoded on access.")
+        else:
+            traces = traces.read()
+            print(f"Read and decoded {traces.shape} samples.")
+    elif mmap:
+        trace_num_2 = (os.path.getsize(file) - 8)//(8*samples_per_trace)
+        assert trace_num == trace_num_2
+        assert trace_num == 2*ntraces, f"{trace_num} != {ntraces}"
+        traces = np.memmap(file, mode='r', offset=8, dtype=np.float64,
+                           shape=(trace_num, samples_per_trace))
+        print(f"Mapped {traces.shape} floats.")
+    else:
+        traces = np.fromfile(file, offset=8, dtype=np.float64)
+        trace_num_2 = traces.shape[0]//samples_per_trace
+        assert trace_num == trace_num_2
+        assert trace_num == 2*ntraces, f"{trace_num} != {ntraces}"
+        print(f"Read {traces.shape} floats.")
+        traces = traces.reshape((trace_num, samples_per_trace))
     print(f"{trace_num=}")
-    traces = traces.reshape((trace_num, samples_per_trace))
     if ignore_bc:
         bcs = None
+    elif mmap:
+        bcs = np.memmap(file_bc, mode='r', offset=4, dtype=np.uint32,
+                        shape=(trace_num, SIMPLECOMPBITS, nshares))
     else:
         bcs = np.fromfile(file_bc, offset=4, dtype=np.uint32,
                       count=SIMPLECOMPBITS*nshares*trace_num)
@@ -56,24 +110,84 @@ def read_traces(ntraces, nshares, file, file_bc, ignore_bc):
     return traces, bcs
 
 
+def write_traces(file, traces, file_bc=None, bcs=None):
+    # Same layout as the ChipWhisperer capture script: the header counts pairs of traces
+    with open(file, 'wb') as f:
+        f.write((traces.shape[0]//2).to_bytes(4, byteorder="big"))
+        f.write(traces.shape[1].to_bytes(4, byteorder="big"))
+        f.write(np.ascontiguousarray(traces, dtype=np.float64).tobytes())
+    if bcs is not None:
+        assert bcs.shape[1] == SIMPLECOMPBITS
+        with open(file_bc, 'wb') as f:
+            f.write(bcs.shape[0].to_bytes(4, byteorder="big"))
+            f.write(np.ascontiguousarray(bcs, dtype=np.uint32).tobytes())
+
+
+# Directory plots are rendered to instead of being shown, see set_plot_export
+PLOT_EXPORT = None
+PLOT_DATA_FORMAT = "txt"
+
+
+def set_plot_export(directory, data_format="txt"):
+    global PLOT_EXPORT
+    global PLOT_DATA_FORMAT
+    if directory is not None:
+        # Non-interactive backend, nothing waits for a window to be closed
+        plt.switch_backend("Agg")
+    PLOT_EXPORT = directory
+    PLOT_DATA_FORMAT = data_format
+
+
+def get_export_file(path, name, extension):
+    # Plots written within the same second get a counter instead of overwriting each other
+    dt_string = datetime.now().strftime("%d%m%Y-%H%M%S")
+    fname = f"{path}/{name}_{dt_string}.{extension}"
+    idx = 1
+    while os.path.exists(fname):
+        fname = f"{path}/{name}_{dt_string}_{idx}.{extension}"
+        idx += 1
+    return fname
+
+
+def show_plot(name="plot"):
+    if PLOT_EXPORT is None:
+        plt.show()
+        return
+    try:
+        os.makedirs(PLOT_EXPORT, exist_ok=True)
+        fname = get_export_file(PLOT_EXPORT, name, "png")
+        plt.savefig(fname)
+        print(f"Saved plot to {fname}.")
+    except OSError as e:
+        print(f"Unable to save plot {name}: {e}", file=sys.stderr)
+    plt.close("all")
+
+
 def print_plt(x, y, name="plot", path="../plot_prints"):
-    now = datetime.now()
-    dt_string = now.strftime("%d%m%Y-%h%m%s")
-    ls = list(zip(x, y))
-    fname = f"{path}/{name}_{dt_string}.txt"
-    print(f"Printing trace to {fname}..")
+    n = min(len(x), len(y))
+    x = np.asarray(x)[:n]
+    y = np.asarray(y)[:n]
     try:
+        os.makedirs(path, exist_ok=True)
+        if PLOT_DATA_FORMAT == "npy":
+            fname = get_export_file(path, name, "npy")
+            print(f"Printing trace to {fname}..")
+            np.save(fname, np.stack([x, y], axis=1))
+            return
+        fname = get_export_file(path, name, "txt")
+        print(f"Printing trace to {fname}..")
+        xs = x.tolist()
+        ys = y.tolist()
         with open(fname, 'w') as f:
-            for i in range(len(ls)):
-                if i % 5000 == 0:
-                    f.write("\n")
-                f.write(f"({ls[i][0]}, {ls[i][1]})")
+            for start in range(0, n, 5000):
+                f.write("\n" + "".join(map("({}, {})".format, xs[start:start+5000], ys[start:start+5000])))
     except OSError as e:
-        print(f"Unable to write {fname}: {e}", file=sys.stderr)
-        print("Are you sure the plot printing directory exists?")
+        print(f"Unable to write plot data {name}: {e}", file=sys.stderr)
 
 
-def plot_traces(traces, titles, locs=None, sharey=False, sharex=False):
+def plot_traces(traces, titles, locs=None, sharey=False, sharex=False, name=None):
+    if name is None:
+        name = titles[0].replace(" ", "_") if isinstance(titles[0], str) else "traces"
     if len(traces) == 1:
         fig, ax = plt.subplots(len(traces), sharey=sharey, sharex=sharex)
         plot_trace(traces[0], titles[0], ax, locs)
@@ -81,7 +195,7 @@ def plot_traces(traces, titles, locs=None, sharey=False, sharex=False):
         fig, axs = plt.subplots(len(traces), sharey=sharey, sharex=sharex)
         for trace, title, ax in zip(traces, titles, axs):
             plot_trace(trace, title, ax, locs)
-    plt.show()
+    show_plot(name)
 
 
 def plot_trace(trace, title, ax, locs=None):
@@ -102,19 +216,34 @@ def plot_trace(trace, title, ax, locs=None):
                     0.1*(max(trace)-min(trace))], color="red")
 
 
-def compute_auto_correlation(traces, max_len=1000, max_dist=5000, min_dist=100, start=300):
+def compute_auto_correlation(traces, max_len=None, max_dist=5000, min_dist=100, start=0, normalize=True, block_size=1024, top=32):
+    num_samples = traces.shape[1]
+    centered = traces - np.mean(traces, axis=0)
+    if normalize:
+        std = np.std(centered, axis=0, ddof=1)
+        centered /= np.where(std > 0, std, 1)
+    if max_len is None:
+        max_len = num_samples
+    lags = np.arange(min_dist, max_dist, min_dist)
+    # Start locations without a single lag inside the trace are dropped
+    loc0s = np.arange(start, min(num_samples - lags[0], max_len)) if lags.shape[0] > 0 else np.arange(0)
+    k = min(top, lags.shape[0])
     cors_outer = []
-    for loc0 in range(start, min(traces.shape[1], max_len)):
-        cors = []
-        for loc1 in range(loc0+min_dist, min(traces.shape[1], loc0+max_dist), min_dist):
-            cor = np.cov(traces[:, loc0], traces[:, loc1])[0][1]
-            cors.append((loc1, cor))
-        cors = list(sorted(cors, key=lambda x: x[1], reverse=True))[:32]
-        if len(cors) != 32:
-            raise ValueError
-        cors = list(sorted(cors, key=lambda x: x[0]))
-        sum_cors = sum(c[1] for c in cors)
-        cors_outer.append((loc0, cors, sum_cors))
+    for block_start in range(0, loc0s.shape[0], block_size):
+        block = loc0s[block_start:block_start+block_size]
+        # cors[i, j] is the correlation (covariance without normalize) between block[i] and block[i]+lags[j]
+        cors = np.full((block.shape[0], lags.shape[0]), -np.inf)
+        for j, lag in enumerate(lags):
+            valid = block + lag < num_samples
+            loc0_valid = block[valid]
+            cors[valid, j] = np.einsum('ij,ij->j', centered[:, loc0_valid], centered[:, loc0_valid+lag])/(traces.shape[0]-1)
+        # Locations near the end are ranked over the lags they have, missing lags are -inf and left out
+        best = np.sort(np.argpartition(-cors, k-1, axis=1)[:, :k], axis=1)
+        best_cors = np.take_along_axis(cors, best, axis=1)
+        for loc0, lag_idx, cor in zip(block, best, best_cors):
+            finite = np.isfinite(cor)
+            lag_idx, cor = lag_idx[finite], cor[finite]
+            cors_outer.append((int(loc0), list(zip((loc0 + lags[lag_idx]).tolist(), cor)), np.sum(cor)))
     best_cors = list(sorted(cors_outer, key=lambda x: x[2], reverse=True))
     return best_cors
 
@@ -138,7 +267,7 @@ def find_poi_manual(traces, start=475, end=500, sel=False, shares=None, min_dist
         assert shares is not None
         current_bit = 0
         current_share = 0
-        pois = [[[None for _ in range(32)] for _ in range(shares)]]
+        pois_col = PoisCollection(1, shares)
         locs = []
         rem_locs = []
     loc = start
@@ -189,7 +318,7 @@ def find_poi_manual(traces, start=475, end=500, sel=False, shares=None, min_dist
                 print(f"Selected {loc} for {current_share=} {current_bit=}.")
                 locs.append(loc)
                 loc_cls = Loc(0, current_share, current_bit, loc)
-                pois[0][current_share][current_bit] = Pois([loc_cls])
+                pois_col.set_pois(0, current_share, current_bit, Pois([loc_cls]))
                 current_bit += 1
                 if current_bit == 32:
                     current_bit = 0
@@ -200,22 +329,22 @@ def find_poi_manual(traces, start=475, end=500, sel=False, shares=None, min_dist
         loc += 1
 
     if sel:
-        pois_col = PoisCollection(1, shares)
-        pois_col.pois = pois
         return pois_col
 
 
 def find_poi_separate_samples(traces):
-    sep_trace_0 = [None for _ in range(traces.shape[1])]
-    sep_trace_1 = [None for _ in range(traces.shape[1])]
-    score_trace = [None for _ in range(traces.shape[1])]
-    for loc in range(traces.shape[1]):
-        samples = traces[:, loc]
-        mean_0, mean_1, score = compute_separation_score(samples, loc)
-        sep_trace_0[loc] = mean_0
-        sep_trace_1[loc] = mean_1
-        score_trace[loc] = score
-    return np.array(sep_trace_0), np.array(sep_trace_1), np.array(score_trace)
+    # Vectorized compute_separation_score for every sample location at once
+    mean = np.mean(traces, axis=0)
+    above = traces >= mean
+    below = traces <= mean
+    l0 = np.sum(above, axis=0)
+    l1 = np.sum(below, axis=0)
+    sep_trace_0 = np.sum(traces, axis=0, where=above)/l0
+    sep_trace_1 = np.sum(traces, axis=0, where=below)/l1
+    score_trace = (sep_trace_1 - sep_trace_0)**2
+    rel = l0/(l0+l1)
+    score_trace[(rel < 0.45) | (rel > 0.55)] = -0.01
+    return sep_trace_0, sep_trace_1, score_trace
 
 
 def compute_separation_score(samples, loc):